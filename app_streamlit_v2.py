@@ -1,11 +1,17 @@
+import copy
 import json
 import streamlit as st
-from app_v2 import extract_fields_ai
+import jobs_v2 as jobs
+from review_v2 import VerificationIndex, keyify
 
 st.set_page_config(page_title="PDF Extractor + Verification", layout="centered")
 
 st.title("📄 PDF Extractor with Verification")
 
+# Extraction runs in background worker processes fed by the job queue; this
+# script only enqueues and polls.
+jobs.ensure_workers()
+
 # ─────────────────────────────────────────────
 # Session Init
 # ─────────────────────────────────────────────
@@ -13,14 +19,30 @@ st.title("📄 PDF Extractor with Verification")
 if "results" not in st.session_state:
     st.session_state.results = {}
 
-if "processed_files" not in st.session_state:
-    st.session_state.processed_files = set()
-
+# Picked PDFs are spooled straight into the job queue's blob store, so the
+# session only keeps {name, sha256, size} per file. Bumping picker_gen gives
+# the uploader a new key, which drops Streamlit's in-memory copies.
 if "staged_files" not in st.session_state:
-    st.session_state.staged_files = []   # list of uploaded file objects
+    st.session_state.staged_files = []   # [{"name", "sha256", "size"}]
+
+if "picker_gen" not in st.session_state:
+    st.session_state.picker_gen = 0
 
 if "processing_started" not in st.session_state:
-    st.session_state.processing_started = False
+    # The batch id lives in the URL, so a refresh picks the batch back up.
+    st.session_state.processing_started = "batch" in st.query_params
+
+# Field edits and verification ticks. Streamlit forgets a widget's state once
+# it stops being rendered (collapsed service, other page), so the widgets
+# write through to this index instead.
+if "review" not in st.session_state:
+    st.session_state.review = VerificationIndex()
+
+if "file_verified" not in st.session_state:
+    st.session_state.file_verified = {}  # file key -> status at the last full run
+
+SERVICES_PER_PAGE = 10
+MAX_STAGED_FILES  = 50
 
 
 # ─────────────────────────────────────────────
@@ -33,10 +55,6 @@ def normalize_result(result):
     return result
 
 
-def keyify(path):
-    return path.replace(".", "_").replace("[", "_").replace("]", "")
-
-
 def pretty_label(path):
     label = path.split(".")[-1]
     return label.replace("_", " ").title()
@@ -46,6 +64,15 @@ def safe_name(name):
     return name.replace(".", "_").replace(" ", "_")
 
 
+def on_edit(widget_key):
+    st.session_state.review.set_edit(widget_key, st.session_state[widget_key])
+    st.session_state.edited = True
+
+
+def on_verify(widget_key):
+    st.session_state.review.set_verified(widget_key, st.session_state[widget_key])
+
+
 # ─────────────────────────────────────────────
 # UI Components
 # ─────────────────────────────────────────────
@@ -62,13 +89,22 @@ def render_leaf(path, value):
     with col2:
         st.text_input(
             label,
-            value if value is not None else "",
+            st.session_state.review.edit_value(f"value_{key_base}", value if value is not None else ""),
             label_visibility="collapsed",
-            key=f"value_{key_base}"
+            key=f"value_{key_base}",
+            on_change=on_edit,
+            args=(f"value_{key_base}",)
         )
 
     with col3:
-        st.checkbox("Verified", key=f"verify_{key_base}", label_visibility="hidden")
+        st.checkbox(
+            "Verified",
+            st.session_state.review.is_checked(f"verify_{key_base}"),
+            key=f"verify_{key_base}",
+            label_visibility="hidden",
+            on_change=on_verify,
+            args=(f"verify_{key_base}",)
+        )
 
 
 def render_pricing(path, pricing_dict):
@@ -83,21 +119,32 @@ def render_pricing(path, pricing_dict):
         with col2:
             st.text_input(
                 "Adults",
-                data.get("adults") or "",
+                st.session_state.review.edit_value(f"value_{path}_{pax}_adults", data.get("adults") or ""),
                 label_visibility="collapsed",
-                key=f"value_{path}_{pax}_adults"
+                key=f"value_{path}_{pax}_adults",
+                on_change=on_edit,
+                args=(f"value_{path}_{pax}_adults",)
             )
 
         with col3:
             st.text_input(
                 "Children",
-                data.get("children") or "",
+                st.session_state.review.edit_value(f"value_{path}_{pax}_children", data.get("children") or ""),
                 label_visibility="collapsed",
-                key=f"value_{path}_{pax}_children"
+                key=f"value_{path}_{pax}_children",
+                on_change=on_edit,
+                args=(f"value_{path}_{pax}_children",)
             )
 
         with col4:
-            st.checkbox("Verified", key=f"verify_{path}_{pax}", label_visibility="hidden")
+            st.checkbox(
+                "Verified",
+                st.session_state.review.is_checked(f"verify_{path}_{pax}"),
+                key=f"verify_{path}_{pax}",
+                label_visibility="hidden",
+                on_change=on_verify,
+                args=(f"verify_{path}_{pax}",)
+            )
 
 
 # ─────────────────────────────────────────────
@@ -124,56 +171,61 @@ def render_field(path, value):
 
 
 # ─────────────────────────────────────────────
-# Verification
-# ─────────────────────────────────────────────
-
-def is_file_verified(file_key):
-    keys = [k for k in st.session_state if k.startswith(f"verify_{file_key}")]
-    return keys and all(st.session_state[k] for k in keys)
-
-
-# ─────────────────────────────────────────────
-# Rebuild JSON
+# Lazy, fragment-scoped rendering
 # ─────────────────────────────────────────────
 
-def rebuild_json(original, path):
-
-    if isinstance(original, dict):
-        new_obj = {}
-
-        for k, v in original.items():
+@st.fragment
+def render_service(file_key, idx, svc):
+    # Widgets are only created once the service is opened, and interacting
+    # with them reruns just this fragment.
+    name  = svc.get("service_name") if isinstance(svc, dict) else None
+    label = f"Service {idx} — {name or 'Unnamed service'}"
+    if not st.toggle(label, key=f"open_{file_key}_{idx}"):
+        return
 
-            if k == "pricing" and isinstance(v, dict):
-                pricing_new = {}
+    with st.container(border=True):
+        render_field(f"{file_key}_service_{idx}", svc)
+        done, total = st.session_state.review.progress(file_key)
+        st.caption(f"{done} of {total} fields verified in this file")
+
+    # The verified JSON lives outside the fragment; refresh the whole page
+    # only when this interaction flipped the file's status or changed a value
+    # that is already in its download. The new status is recorded before the
+    # rerun, otherwise the rerun renders this fragment again before stage 3
+    # records it, and reruns again.
+    verified = is_file_verified(file_key)
+    edited   = st.session_state.pop("edited", False)
+    if verified != st.session_state.file_verified.get(file_key) or (verified and edited):
+        st.session_state.file_verified[file_key] = verified
+        st.rerun()
 
-                for pax, data in v.items():
-                    pricing_new[pax] = {
-                        "adults": st.session_state.get(
-                            f"value_{path}.{k}_{pax}_adults",
-                            data.get("adults")
-                        ),
-                        "children": st.session_state.get(
-                            f"value_{path}.{k}_{pax}_children",
-                            data.get("children")
-                        ),
-                    }
 
-                new_obj[k] = pricing_new
+@st.fragment
+def render_services(file_key, services):
+    pages = -(-len(services) // SERVICES_PER_PAGE)
+    page  = 0
+    if pages > 1:
+        page = st.selectbox(
+            "Page",
+            range(pages),
+            format_func=lambda p: (
+                f"Services {p * SERVICES_PER_PAGE + 1}–"
+                f"{min((p + 1) * SERVICES_PER_PAGE, len(services))} of {len(services)}"
+            ),
+            key=f"page_{file_key}"
+        )
 
-            else:
-                new_obj[k] = rebuild_json(v, f"{path}.{k}")
+    start = page * SERVICES_PER_PAGE
+    for i, svc in enumerate(services[start:start + SERVICES_PER_PAGE], start=start):
+        render_service(file_key, i + 1, svc)
 
-        return new_obj
 
-    elif isinstance(original, list):
-        return [
-            rebuild_json(item, f"{path}[{i}]")
-            for i, item in enumerate(original)
-        ]
+# ─────────────────────────────────────────────
+# Verification
+# ─────────────────────────────────────────────
 
-    else:
-        key_base = keyify(path)
-        return st.session_state.get(f"value_{key_base}", original)
+def is_file_verified(file_key):
+    return st.session_state.review.is_verified(file_key)
 
 
 # ─────────────────────────────────────────────
@@ -184,22 +236,25 @@ if not st.session_state.processing_started:
 
     # File uploader (does NOT auto-process)
     new_files = st.file_uploader(
-        "Select PDFs to upload (up to 5)",
+        f"Select PDFs to upload (up to {MAX_STAGED_FILES})",
         type=["pdf"],
         accept_multiple_files=True,
-        key="file_picker"
+        key=f"file_picker_{st.session_state.picker_gen}"
     )
 
-    # Merge newly picked files into the staged queue (avoid duplicates by name)
+    # Spool newly picked files into the staged queue (avoid duplicates by name)
     if new_files:
-        existing_names = {f.name for f in st.session_state.staged_files}
+        existing_names = {f["name"] for f in st.session_state.staged_files}
         for f in new_files:
             if f.name not in existing_names:
-                if len(st.session_state.staged_files) >= 5:
-                    st.warning("Maximum 5 files allowed. Some files were not added.")
+                if len(st.session_state.staged_files) >= MAX_STAGED_FILES:
+                    st.warning(f"Maximum {MAX_STAGED_FILES} files allowed. Some files were not added.")
                     break
-                st.session_state.staged_files.append(f)
+                sha256, size = jobs.store_pdf(f)
+                st.session_state.staged_files.append({"name": f.name, "sha256": sha256, "size": size})
                 existing_names.add(f.name)
+        st.session_state.picker_gen += 1
+        st.rerun()
 
     # Show the staged queue with remove buttons
     if st.session_state.staged_files:
@@ -209,13 +264,11 @@ if not st.session_state.processing_started:
         for idx, f in enumerate(st.session_state.staged_files):
             col_name, col_size, col_btn = st.columns([5, 2, 1])
             with col_name:
-                st.markdown(f"📄 **{f.name}**")
+                st.markdown(f"📄 **{f['name']}**")
             with col_size:
-                size_kb = len(f.getvalue()) / 1024
-                st.caption(f"{size_kb:.1f} KB")
-                f.seek(0)          # reset pointer after getvalue()
+                st.caption(f"{f['size'] / 1024:.1f} KB")
             with col_btn:
-                if st.button("✕", key=f"remove_{idx}", help=f"Remove {f.name}"):
+                if st.button("✕", key=f"remove_{idx}", help=f"Remove {f['name']}"):
                     to_remove = idx
 
         if to_remove is not None:
@@ -231,6 +284,11 @@ if not st.session_state.processing_started:
                 type="primary",
                 use_container_width=True
             ):
+                batch_id = jobs.new_batch_id()
+                for f in st.session_state.staged_files:
+                    jobs.enqueue_stored(f["sha256"], f["name"], batch_id)
+                st.query_params["batch"] = batch_id
+                st.session_state.staged_files = []
                 st.session_state.processing_started = True
                 st.rerun()
         with col_clear:
@@ -243,32 +301,71 @@ if not st.session_state.processing_started:
 
 
 # ─────────────────────────────────────────────
-# STAGE 2 — Sequential processing (one file per rerun)
+# STAGE 2 — Background extraction (job queue)
 # ─────────────────────────────────────────────
 
-if st.session_state.processing_started and st.session_state.staged_files:
-
-    pending = [
-        f for f in st.session_state.staged_files
-        if safe_name(f.name) not in st.session_state.processed_files
-    ]
-
-    if pending:
-        total = len(st.session_state.staged_files)
-        done  = total - len(pending)
-        next_file = pending[0]
-        st.info(f"⏳ Processing file {done + 1} of {total}: **{next_file.name}**")
+def load_finished(batch):
+    # Moves finished jobs into session results; True if any were new.
+    added = False
+    for job in batch:
+        fname = safe_name(job["filename"])
+        if job["state"] not in ("done", "failed") or fname in st.session_state.results:
+            continue
+        # Results are kept exactly as the model returned them, for display and
+        # the raw download.
+        st.session_state.results[fname] = {
+            "original_name": job["filename"],
+            "data": job["result"] if job["state"] == "done" else job["error"]
+        }
+        added = True
+    return added
+
+
+@st.fragment(run_every=jobs.JOB_POLL_SECONDS)
+def poll_batch(batch_id):
+    batch    = jobs.batch_status(batch_id)
+    total    = len(batch)
+    finished = sum(job["state"] in ("done", "failed") for job in batch)
+
+    # New results render in stage 3, outside this fragment.
+    if load_finished(batch):
+        st.rerun()
+    if finished == total:
+        return
 
-        with st.spinner(f"Extracting data from {next_file.name}…"):
-            result = extract_fields_ai(next_file)
-            fname  = safe_name(next_file.name)
-            st.session_state.results[fname] = {
-                "original_name": next_file.name,
-                "data": result
-            }
-            st.session_state.processed_files.add(fname)
+    st.info(f"⏳ Extracting {total - finished} file(s) in the background — safe to refresh or come back later.")
+    st.progress(finished / total, text=f"{finished} of {total} file(s) done")
 
-        st.rerun()
+    for job in batch:
+        if job["state"] in ("done", "failed"):
+            continue
+        with st.container(border=True):
+            col_name, col_status = st.columns([5, 3])
+            with col_name:
+                st.markdown(f"📄 **{job['filename']}**")
+            with col_status:
+                streamed = job["partial"] or []
+                if job["state"] == "queued" and job["attempts"]:
+                    st.caption(f"🔁 Retrying ({job['attempts']}/{job['max_attempts']} attempts used)…")
+                elif job["state"] == "queued":
+                    st.caption("🕒 Queued…")
+                elif streamed:
+                    st.caption(f"🔄 {len(streamed)} service(s) so far…")
+                else:
+                    st.caption("⏳ Extracting…")
+            if streamed:
+                st.markdown("\n".join(
+                    f"- {svc.get('service_name') or 'Unnamed service'} — {svc.get('travel_type') or '?'}"
+                    for svc in streamed
+                ))
+
+
+if st.session_state.processing_started and "batch" in st.query_params:
+    batch_id = st.query_params["batch"]
+    batch    = jobs.batch_status(batch_id)
+    load_finished(batch)
+    if any(job["state"] not in ("done", "failed") for job in batch):
+        poll_batch(batch_id)
 
 
 # ─────────────────────────────────────────────
@@ -283,9 +380,17 @@ for fname, payload in st.session_state.results.items():
     st.markdown(f"# 📁 {file_display}")
 
     if isinstance(result, dict) and result.get("error"):
-        st.error("Extraction failed")
-        st.write(result)
-        continue
+        if not result.get("partial"):
+            st.error("Extraction failed")
+            st.write(result)
+            continue
+        # Every model failed, but a cut-off stream left some complete
+        # services behind: offer those for review, flagged as incomplete.
+        st.warning(
+            f"⚠️ Extraction incomplete ({result['error']}) — showing {len(result['partial'])} service(s) "
+            f"recovered before it was cut off. Check the PDF for any that are missing."
+        )
+        result = result["partial"]
 
     services = normalize_result(result)
 
@@ -300,23 +405,21 @@ for fname, payload in st.session_state.results.items():
     )
 
     # ── Per-service editable fields ─────────────────────────────────────────
-    for i, svc in enumerate(services):
-        idx = i + 1
-        with st.expander(f"Service {idx}", expanded=False):
-            render_field(f"{fname}_service_{idx}", svc)
+    st.session_state.review.register(fname, services)
+    render_services(fname, services)
 
     st.markdown("---")
 
     # ── Verified download ───────────────────────────────────────────────────
-    if not is_file_verified(fname):
-        st.warning(f"⚠️ Please verify all fields for {file_display}")
+    verified = is_file_verified(fname)
+    st.session_state.file_verified[fname] = verified
+    if not verified:
+        done, total = st.session_state.review.progress(fname)
+        st.warning(f"⚠️ Please verify all fields for {file_display} — {done} of {total} verified")
     else:
         st.success(f"✅ {file_display} verified!")
 
-        final_json = [
-            rebuild_json(svc, f"{fname}_service_{i+1}")
-            for i, svc in enumerate(services)
-        ]
+        final_json = st.session_state.review.rebuild(fname, copy.deepcopy(services))
 
         st.json(final_json)
 
@@ -338,6 +441,7 @@ for fname, payload in st.session_state.results.items():
 if st.session_state.processing_started:
     st.markdown("---")
     if st.button("🔄 Start over with new files"):
-        for key in ["results", "processed_files", "staged_files", "processing_started"]:
+        for key in ["results", "staged_files", "processing_started", "review", "file_verified"]:
             del st.session_state[key]
+        st.query_params.clear()
         st.rerun()
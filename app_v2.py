@@ -3,24 +3,51 @@
 
 import os
 import io
+import re
 import json
+import mmap
 import time
-import random
+import asyncio
+import hashlib
+import importlib
+import queue
+import weakref
 import threading
-from google import genai
-from google.genai import types
+from collections import deque
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 
-import streamlit as st
+import config_v2 as config
+import metrics_v2 as metrics
 
 # ── ENV ───────────────────────────────────────────────────────────────────────
-api_key = st.secrets["GOOGLE_API"]
-if not api_key:
-    raise RuntimeError("Please set GOOGLE_API in your environment (.env).")
+# Importing this module does no I/O and pulls in neither streamlit nor
+# google.genai: the API key and model chain are read through config_v2 on
+# first use, and the SDK is imported when the first client or request part is
+# built. Worker processes and the CLI start fast and run outside Streamlit.
+def get_api_key() -> str:
+    key = config.get("api_key")
+    if not key:
+        raise RuntimeError("Please set GOOGLE_API in your environment, .streamlit/secrets.toml or EXTRACT_CONFIG.")
+    return key
 
-print("🔑 [Init] Loaded environment variables and API key.")
+
+class _LazyModule:
+    def __init__(self, name: str):
+        self._name   = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+types = _LazyModule("google.genai.types")
 
 
 # ── MODEL FALLBACK CHAIN ──────────────────────────────────────────────────────
+# The default chain; EXTRACT_MODELS (env, config file or secrets) replaces it.
 FALLBACK_MODELS = [
     "models/gemini-2.5-flash",
     "models/gemini-2.5-flash-image",
@@ -30,13 +57,130 @@ FALLBACK_MODELS = [
 
 MODEL_TIMEOUT_SECONDS = 30
 
-print(f"🔗 [Init] Model fallback chain: {FALLBACK_MODELS}")
+_models = None
+
+
+def get_models() -> list:
+    # Follows config_v2.use(); the chain is logged whenever it changes.
+    global _models
+    models = config.get_list("models", FALLBACK_MODELS)
+    if models != _models:
+        _models = models
+        print(f"🔗 [Init] Model fallback chain: {models}")
+    return _models
 
 
 # ── CLIENT ────────────────────────────────────────────────────────────────────
-def get_client():
+# genai.Client and its httpx connection pools are thread-safe, so extractions
+# share a small process-wide set of clients (handed out round-robin) instead of
+# paying TLS/connection setup for every document. Each client's httpx pool is
+# instrumented so connection reuse can be checked with get_client_stats().
+# The async side of a client stays bound to the event loop it first ran on, so
+# async extractions take theirs from get_async_client(), one per running loop.
+CLIENT_POOL_SIZE      = 2
+HTTP_MAX_CONNECTIONS  = 32   # per client
+HTTP_MAX_KEEPALIVE    = 16   # idle connections kept open per client
+
+_client_lock  = threading.Lock()
+_clients      = []
+_client_turn  = 0
+_async_clients = weakref.WeakKeyDictionary()    # event loop -> client
+_client_stats = {"clients_created": 0, "leases": 0, "http_requests": 0, "new_connections": 0, "tls_handshakes": 0}
+
+
+def _client_record(**increments):
+    with _client_lock:
+        for k, v in increments.items():
+            _client_stats[k] += v
+
+
+def _trace_connection(event_name, info):
+    if event_name == "connection.connect_tcp.complete":
+        _client_record(new_connections=1)
+    elif event_name == "connection.start_tls.complete":
+        _client_record(tls_handshakes=1)
+
+
+async def _trace_connection_async(event_name, info):
+    _trace_connection(event_name, info)
+
+
+def _on_request(request):
+    _client_record(http_requests=1)
+    request.extensions["trace"] = _trace_connection
+
+
+async def _on_request_async(request):
+    _client_record(http_requests=1)
+    request.extensions["trace"] = _trace_connection_async
+
+
+def _new_client():
+    import httpx
+    from google import genai
+
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+    )
+    http_options = types.HttpOptions(
+        client_args={"limits": limits, "event_hooks": {"request": [_on_request]}},
+        async_client_args={"limits": limits, "event_hooks": {"request": [_on_request_async]}},
+    )
     print("🤖 [Gemini] Creating Gemini client instance.")
-    return genai.Client(api_key=api_key)
+    return genai.Client(api_key=get_api_key(), http_options=http_options)
+
+
+def get_client():
+    global _client_turn
+    with _client_lock:
+        if len(_clients) < CLIENT_POOL_SIZE:
+            _clients.append(_new_client())
+            _client_stats["clients_created"] += 1
+        client = _clients[_client_turn % len(_clients)]
+        _client_turn += 1
+        _client_stats["leases"] += 1
+    return client
+
+
+def get_async_client():
+    # The client for the running event loop; dropped along with the loop.
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = _async_clients[loop] = _new_client()
+            _client_stats["clients_created"] += 1
+        _client_stats["leases"] += 1
+    return client
+
+
+def reset_clients():
+    with _client_lock:
+        old = list(_clients)
+        _clients.clear()
+        _async_clients.clear()
+    for client in old:
+        close = getattr(client, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                print(f"⚠️  [Gemini] Could not close client: {e}")
+
+
+def get_client_stats() -> dict:
+    with _client_lock:
+        stats = dict(_client_stats)
+        stats["pool_size"] = len(_clients)
+    requests = stats["http_requests"]
+    stats["connection_reuse_rate"] = (
+        round(1 - stats["new_connections"] / requests, 3) if requests else None
+    )
+    stats["client_reuse_rate"] = (
+        round(1 - stats["clients_created"] / stats["leases"], 3) if stats["leases"] else None
+    )
+    return stats
 
 
 # ── SERVICE TEMPLATE ──────────────────────────────────────────────────────────
@@ -153,68 +297,1749 @@ Now extract ALL services from this PDF.
 """
 
 
+# Compiled once at import: the prompt depends only on SERVICE_TEMPLATE, and its
+# hash keys both the result cache and the server-side context cache.
+PROMPT      = _make_prompt()
+PROMPT_HASH = hashlib.sha256(PROMPT.encode("utf-8")).hexdigest()[:16]
+
+
+# ── RESPONSE SCHEMA ───────────────────────────────────────────────────────────
+# Structured output: the model is constrained to a JSON schema derived from
+# SERVICE_TEMPLATE, so responses arrive as a well-formed array of complete
+# services and the repair path (and the fallback attempts it triggers) becomes
+# the exception. Image-generation models reject response_schema and keep
+# running unconstrained. The same schema is compiled into a local validator
+# that checks every parsed service.
+STRUCTURED_OUTPUT = True
+
+TRAVEL_TYPES      = ["arrival", "departure", "transfer"]
+FAST_TRACK_VALUES = ["fast track", "expedited", "assistance", "no assistance"]
+
+
+def _schema_from_template(value, path: str = "") -> dict:
+    if isinstance(value, dict):
+        return {
+            "type": "OBJECT",
+            "properties": {
+                k: _schema_from_template(v, f"{path}.{k}" if path else k) for k, v in value.items()
+            },
+            "required": list(value),
+            "property_ordering": list(value),
+        }
+    if isinstance(value, list):
+        return {"type": "ARRAY", "items": {"type": "STRING"}}
+    if path == "travel_type":
+        return {"type": "STRING", "enum": TRAVEL_TYPES}
+    if path.startswith("fast_track."):
+        return {"type": "STRING", "enum": FAST_TRACK_VALUES, "nullable": True}
+    if path.startswith("pricing."):
+        return {"type": "NUMBER", "nullable": True}
+    return {"type": "STRING", "nullable": True}
+
+
+RESPONSE_SCHEMA = {"type": "ARRAY", "items": _schema_from_template(SERVICE_TEMPLATE)}
+
+
+def _supports_schema(model: str | None) -> bool:
+    return STRUCTURED_OUTPUT and model is not None and "image" not in model
+
+
+_SCHEMA_TYPES = {
+    "OBJECT":  dict,
+    "ARRAY":   list,
+    "STRING":  str,
+    "NUMBER":  (int, float),
+    "INTEGER": int,
+    "BOOLEAN": bool,
+}
+
+
+def _compile_validator(schema: dict, path: str = ""):
+    # Turns a schema node into a closure check(value, errors) once, so
+    # validating a response is plain isinstance/dict lookups with no schema
+    # walking per service.
+    expected = _SCHEMA_TYPES[schema["type"]]
+    nullable = schema.get("nullable", False)
+    enum     = frozenset(schema["enum"]) if "enum" in schema else None
+    label    = path or "<root>"
+
+    fields, required, items = (), (), None
+    if schema["type"] == "OBJECT":
+        fields   = tuple(
+            (k, _compile_validator(sub, f"{path}.{k}" if path else k))
+            for k, sub in schema["properties"].items()
+        )
+        required = tuple(schema.get("required", ()))
+    elif schema["type"] == "ARRAY":
+        items = _compile_validator(schema["items"], f"{path}[]")
+
+    def check(value, errors: list):
+        if value is None:
+            if not nullable:
+                errors.append(f"{label}: null")
+            return
+        if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+            errors.append(f"{label}: expected {schema['type'].lower()}, got {type(value).__name__}")
+            return
+        if enum is not None and value not in enum:
+            errors.append(f"{label}: {value!r} not in {sorted(enum)}")
+        for k in required:
+            if k not in value:
+                errors.append(f"{path}.{k}: missing" if path else f"{k}: missing")
+        for k, sub in fields:
+            if k in value:
+                sub(value[k], errors)
+        if items is not None:
+            for item in value:
+                items(item, errors)
+
+    return check
+
+
+_validate_service = _compile_validator(RESPONSE_SCHEMA["items"])
+
+
+def validate_services(services: list) -> list:
+    # Returns [{"service_index", "errors"}] for services that break the schema.
+    report = []
+    for idx, svc in enumerate(services):
+        errors = []
+        _validate_service(svc, errors)
+        if errors:
+            report.append({"service_index": idx, "errors": errors})
+    return report
+
+
+# ── SERVICE MODEL ─────────────────────────────────────────────────────────────
+# Compact in-memory form of one extracted service, laid out from
+# SERVICE_TEMPLATE: the flat fields share one list in template order, the N_pax
+# pricing table is a fixed-size flat list (adults, children per tier) and the
+# fast_track leaves are a tuple — five slots per service instead of a dozen
+# nested dicts. from_dict fills missing template keys and coerces price strings
+# ("€475", "1,250.00 EUR") to numbers in the same pass; to_dict gives back the
+# template-shaped dict. Whatever doesn't fit the template — unknown keys at any
+# level ("infants", "11_pax") or a plain value where it expects an object
+# ("fast_track": "yes") — is kept in `extra` and laid back over to_dict's
+# output, so nothing the model returned is lost.
+PAX_TIERS         = tuple(SERVICE_TEMPLATE["pricing"])                  # "1_pax" … "10_pax"
+PRICE_FIELDS      = tuple(SERVICE_TEMPLATE["pricing"][PAX_TIERS[0]])    # "adults", "children"
+FAST_TRACK_FIELDS = tuple(
+    (direction, leaf)
+    for direction, leaves in SERVICE_TEMPLATE["fast_track"].items()
+    for leaf in leaves
+)
+SCALAR_FIELDS     = tuple(k for k, v in SERVICE_TEMPLATE.items() if not isinstance(v, (dict, list)))
+
+_SCALAR_DEFAULTS = tuple((k, SERVICE_TEMPLATE[k]) for k in SCALAR_FIELDS)
+_SCALAR_INDEX    = {k: i for i, k in enumerate(SCALAR_FIELDS)}
+_PRICE_SLOTS     = len(PAX_TIERS) * len(PRICE_FIELDS)
+
+# Field-path index: every template leaf as a dotted path, in template order.
+# Completeness checks compare services against this once-built list instead of
+# walking each service and building path strings. service_details is a
+# free-form list and is never flagged.
+FIELD_PATHS = tuple(
+    path
+    for key, value in SERVICE_TEMPLATE.items() if not isinstance(value, list)
+    for path in (
+        [f"{key}.{sub}.{leaf}" for sub, leaves in value.items() for leaf in leaves]
+        if isinstance(value, dict) else [key]
+    )
+)
+
+# The same index as a fixed two-level tree for plain dicts: (key, None) for a
+# flat field, (key, ((sub, leaves), …)) for pricing / fast_track.
+_FIELD_TREE = tuple(
+    (key, None if not isinstance(value, dict) else tuple((sub, tuple(leaves)) for sub, leaves in value.items()))
+    for key, value in SERVICE_TEMPLATE.items() if not isinstance(value, list)
+)
+
+# Service.leaf_values() layout: slices of the flat-field list interleaved with
+# the pricing and fast_track blocks, in template order.
+def _leaf_plan() -> tuple:
+    plan = []
+    for key, value in SERVICE_TEMPLATE.items():
+        if isinstance(value, dict):
+            plan.append(key)
+        elif not isinstance(value, list):
+            i = _SCALAR_INDEX[key]
+            if plan and isinstance(plan[-1], tuple):
+                plan[-1] = (plan[-1][0], i + 1)
+            else:
+                plan.append((i, i + 1))
+    return tuple(plan)
+
+
+_LEAF_PLAN = _leaf_plan()
+
+_CURRENCY = r"(?:[€$£]|eur|usd|gbp|aed)"
+_PRICE_RE = re.compile(
+    rf"^\s*{_CURRENCY}?\s*(\d{{1,3}}(?:,\d{{3}})+|\d+)(\.\d+)?\s*{_CURRENCY}?\s*$", re.IGNORECASE
+)
+
+
+def _coerce_price(value):
+    if not isinstance(value, str):
+        return value
+    m = _PRICE_RE.match(value)
+    if m is None:
+        return value or None          # "" → null; "on request" stays as text
+    whole = m.group(1).replace(",", "")
+    return float(whole + m.group(2)) if m.group(2) else int(whole)
+
+
+def _child(obj, key):
+    value = obj.get(key) if isinstance(obj, dict) else None
+    return value if isinstance(value, dict) else None
+
+
+def _off_template(value, shape: dict):
+    # The parts of `value` a template-shaped dict can't hold, or None.
+    if not isinstance(value, dict):
+        return None if value in (None, "") else value
+    extra = {}
+    for k, v in value.items():
+        if k not in shape:
+            extra[k] = v
+        elif isinstance(shape[k], dict):
+            off = _off_template(v, shape[k])
+            if off is not None:
+                extra[k] = off
+    return extra or None
+
+
+def _overlay(out: dict, extra: dict):
+    for k, v in extra.items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            _overlay(out[k], v)
+        else:
+            out[k] = v
+
+
+class Service:
+    __slots__ = ("scalars", "pricing", "fast_track", "service_details", "extra")
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Service":
+        get  = data.get
+        self = cls.__new__(cls)
+        self.scalars = [get(k, default) for k, default in _SCALAR_DEFAULTS]
+
+        pricing = [None] * _PRICE_SLOTS
+        table   = _child(data, "pricing")
+        if table is not None:
+            i = 0
+            for tier in PAX_TIERS:
+                entry = _child(table, tier)
+                if entry is not None:
+                    for j, field in enumerate(PRICE_FIELDS):
+                        pricing[i + j] = _coerce_price(entry.get(field))
+                i += len(PRICE_FIELDS)
+        self.pricing = pricing
+
+        fast = _child(data, "fast_track")
+        self.fast_track = tuple(
+            (_child(fast, direction) or {}).get(leaf) for direction, leaf in FAST_TRACK_FIELDS
+        )
+
+        details = get("service_details")
+        if isinstance(details, list):
+            self.service_details = list(details)
+        else:
+            self.service_details = [] if details in (None, "") else [details]
+
+        self.extra = _off_template(data, SERVICE_TEMPLATE)
+        return self
+
+    def to_dict(self) -> dict:
+        out     = {}
+        scalars = iter(self.scalars)
+        width   = len(PRICE_FIELDS)
+        for key in SERVICE_TEMPLATE:
+            if key == "pricing":
+                out[key] = {
+                    tier: dict(zip(PRICE_FIELDS, self.pricing[i * width:(i + 1) * width]))
+                    for i, tier in enumerate(PAX_TIERS)
+                }
+            elif key == "fast_track":
+                fast = {}
+                for (direction, leaf), value in zip(FAST_TRACK_FIELDS, self.fast_track):
+                    fast.setdefault(direction, {})[leaf] = value
+                out[key] = fast
+            elif key == "service_details":
+                out[key] = list(self.service_details)
+            else:
+                out[key] = next(scalars)
+        if self.extra:
+            _overlay(out, self.extra)
+        return out
+
+    def get(self, key: str, default=None):
+        i = _SCALAR_INDEX.get(key)
+        return default if i is None else self.scalars[i]
+
+    def __getitem__(self, key: str):
+        return self.scalars[_SCALAR_INDEX[key]]
+
+    def leaf_values(self) -> list:
+        # Values aligned with FIELD_PATHS.
+        out = []
+        for segment in _LEAF_PLAN:
+            if segment == "pricing":
+                out += self.pricing
+            elif segment == "fast_track":
+                out += self.fast_track
+            else:
+                out += self.scalars[segment[0]:segment[1]]
+        return out
+
+    def missing_fields(self) -> list:
+        return [path for path, value in zip(FIELD_PATHS, self.leaf_values()) if value in _BLANK]
+
+    def __repr__(self) -> str:
+        return f"Service({self.get('service_name')!r}, {self.get('travel_type')!r})"
+
+
+def to_services(service_list: list) -> list:
+    # Items that aren't objects at all are passed through for the caller.
+    return [Service.from_dict(svc) if isinstance(svc, dict) else svc for svc in service_list]
+
+
+# ── RESULT CACHE ──────────────────────────────────────────────────────────────
+# Parsed results are stored on disk, one JSON file per (PDF, prompt, model),
+# so a PDF we have already seen comes back without any Gemini round-trip.
+CACHE_DIR = os.environ.get(
+    "EXTRACT_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".extract_cache")
+)
+CACHE_MAX_BYTES       = 256 * 1024 * 1024   # evict least-recently-used beyond this
+CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600      # entries older than this are dropped
+CACHE_SWEEP_EVERY     = 200                 # stores between full sweeps for expired entries
+CACHE_EVICT_TO        = 0.9                 # a size eviction frees down to this share of the limit
+
+# Stores keep a running byte total, so the directory is only walked when a
+# store takes it over CACHE_MAX_BYTES, every CACHE_SWEEP_EVERY stores (which
+# also re-syncs the total with writes from other processes) and the first
+# time this process stores anything.
+_cache_lock  = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "bypassed": 0}
+_cache_bytes = None     # running size of CACHE_DIR; None until the first sweep
+
+
+def _cache_path(pdf_hash: str, model: str) -> str:
+    key = hashlib.sha256(f"{pdf_hash}:{PROMPT_HASH}:{model}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.json")
+
+
+def _cache_lookup(pdf_hash: str):
+    now = time.time()
+    for model in get_models():
+        path = _cache_path(pdf_hash, model)
+        try:
+            if now - os.path.getmtime(path) > CACHE_MAX_AGE_SECONDS:
+                os.remove(path)
+                continue
+            with open(path, "r", encoding="utf-8") as fh:
+                entry = json.load(fh)
+            os.utime(path)            # mark as recently used for LRU eviction
+        except (OSError, ValueError):
+            continue
+
+        with _cache_lock:
+            _cache_stats["hits"] += 1
+        print(f"⚡ [Cache] Hit for {pdf_hash[:12]}… (answered by {model})")
+        return entry["services"]
+
+    with _cache_lock:
+        _cache_stats["misses"] += 1
+    return None
+
+
+def _cache_store(pdf_hash: str, model: str, services: list, filename: str):
+    path = _cache_path(pdf_hash, model)
+    entry = {
+        "pdf_sha256": pdf_hash,
+        "model": model,
+        "filename": filename,
+        "created_at": time.time(),
+        "services": services,
+    }
+    global _cache_bytes
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(entry, fh)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        size     = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠️  [Cache] Could not write cache entry: {e}")
+        return
+
+    with _cache_lock:
+        _cache_stats["writes"] += 1
+        if _cache_bytes is not None:
+            _cache_bytes += size - replaced
+        sweep = (_cache_bytes is None or _cache_bytes > CACHE_MAX_BYTES
+                 or _cache_stats["writes"] % CACHE_SWEEP_EVERY == 0)
+    if sweep:
+        _evict_cache()
+
+
+def _cache_entries():
+    entries = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+    for root, _dirs, files in os.walk(CACHE_DIR):
+        for name in files:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+    return entries
+
+
+def _evict_cache():
+    global _cache_bytes
+    now      = time.time()
+    entries  = sorted(_cache_entries())
+    total    = sum(size for _, size, _ in entries)
+    evicted  = 0
+    # Going over the limit frees some headroom, so the next stores don't each
+    # trigger another walk.
+    target   = CACHE_MAX_BYTES * CACHE_EVICT_TO if total > CACHE_MAX_BYTES else CACHE_MAX_BYTES
+
+    for mtime, size, path in entries:
+        if now - mtime <= CACHE_MAX_AGE_SECONDS and total <= target:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total   -= size
+        evicted += 1
+
+    with _cache_lock:
+        _cache_bytes = total
+    if evicted:
+        with _cache_lock:
+            _cache_stats["evictions"] += evicted
+        print(f"🧹 [Cache] Evicted {evicted} entr{'y' if evicted == 1 else 'ies'}.")
+
+
+def get_cache_stats() -> dict:
+    entries = _cache_entries()
+    with _cache_lock:
+        stats = dict(_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+    stats["entries"]  = len(entries)
+    stats["bytes"]    = sum(size for _, size, _ in entries)
+    return stats
+
+
+def clear_cache():
+    global _cache_bytes
+    for _, _, path in _cache_entries():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    with _cache_lock:
+        _cache_bytes = None
+        for k in _cache_stats:
+            _cache_stats[k] = 0
+
+
 # ── FILE UPLOAD HELPER ────────────────────────────────────────────────────────
-def _upload_pdf(client, pdf_bytes: bytes, filename: str):
+# PDFs up to INLINE_PDF_MAX_BYTES are sent inline as a bytes part of the
+# generate request, which saves the upload and delete round-trips. Larger
+# documents go through the Files API. Pass inline_max_bytes=0 to always upload.
+#
+# A PDF is never copied whole on the way: files on disk (paths, open handles,
+# PdfBuffer.open) are memory-mapped and in-memory files are used through
+# getbuffer(), so hashing reads the buffer in place and uploads stream from it
+# in chunks. Only inline PDFs become one bytes object, for the request body.
+INLINE_PDF_MAX_BYTES = 2 * 1024 * 1024
+
+
+def _map_file(fileno: int):
+    try:
+        return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+    except ValueError:      # empty file — mmap refuses zero length
+        return memoryview(b"")
+
+
+class PdfBuffer(io.RawIOBase):
+    # Read-only, seekable file over a buffer, without copying it.
+    def __init__(self, data, name: str = "document.pdf"):
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self._pos  = 0
+        self.name  = name
+
+    @classmethod
+    def open(cls, path, name=None):
+        # Maps the file at `path`; `name` is what the extraction reports.
+        with open(path, "rb") as fh:
+            view = _map_file(fh.fileno())
+        return cls(view, name or os.path.basename(path))
+
+    def getbuffer(self):
+        return self._view
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def _pdf_name(pdf_file) -> str:
+    if isinstance(pdf_file, (str, os.PathLike)):
+        return os.path.basename(pdf_file)
+    return getattr(pdf_file, "name", "document.pdf")
+
+
+def _pdf_view(pdf_file):
+    # The PDF's bytes from the current position on, as a buffer: a path, a
+    # file-like with getbuffer() (BytesIO, Streamlit uploads, PdfBuffer), a
+    # real file (mapped), or anything else with read().
+    if isinstance(pdf_file, (str, os.PathLike)):
+        return PdfBuffer.open(pdf_file).getbuffer()
+    getbuffer = getattr(pdf_file, "getbuffer", None)
+    if getbuffer is not None:
+        return getbuffer()[pdf_file.tell():]
+    try:
+        fileno = pdf_file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return pdf_file.read()
+    return _map_file(fileno)[pdf_file.tell():]
+
+
+def _upload_pdf(client, pdf_bytes, filename: str):
     print(f"📤 [Upload] Uploading {filename} to Gemini Files API...")
-    pdf_stream = io.BytesIO(pdf_bytes)
-    pdf_stream.name = filename
+    pdf_stream = PdfBuffer(pdf_bytes, filename)
 
-    uploaded = client.files.upload(
-        file=pdf_stream,
-        config={"mime_type": "application/pdf", "display_name": filename}
-    )
+    with metrics.stage("upload"):
+        uploaded = client.files.upload(
+            file=pdf_stream,
+            config={"mime_type": "application/pdf", "display_name": filename}
+        )
     print(f"✅ [Upload] File uploaded — URI: {uploaded.uri}")
     return uploaded
 
 
 def _delete_file(client, uploaded_file):
     try:
-        client.files.delete(name=uploaded_file.name)
+        with metrics.stage("delete"):
+            client.files.delete(name=uploaded_file.name)
         print(f"🗑️  [Upload] Cleaned up remote file: {uploaded_file.name}")
     except Exception as e:
         print(f"⚠️  [Upload] Could not delete remote file: {e}")
 
 
 # ── STREAMING CALL WITH TIMEOUT ───────────────────────────────────────────────
-def _call_streaming_with_timeout(client, model, uploaded_file, prompt, timeout=MODEL_TIMEOUT_SECONDS):
-    result = {"text": None, "error": None}
+RETRYABLE = ("503", "429", "500", "UNAVAILABLE", "RESOURCE_EXHAUSTED", "INTERNAL", "TIMEOUT")
+
+
+def _is_retryable(err: str) -> bool:
+    return any(code in err for code in RETRYABLE)
+
+
+def _file_part(uploaded_file):
+    return types.Part.from_uri(file_uri=uploaded_file.uri, mime_type="application/pdf")
+
+
+def _inline_part(pdf_bytes):
+    return types.Part.from_bytes(data=bytes(pdf_bytes), mime_type="application/pdf")
+
+
+def _build_contents(pdf_part, prompt):
+    parts = [pdf_part]
+    if prompt is not None:
+        parts.append(types.Part.from_text(text=prompt))
+    return [types.Content(role="user", parts=parts)]
+
+
+# ── CONTEXT CACHING ───────────────────────────────────────────────────────────
+# Optional: the static instruction block is registered once per model as
+# server-side cached content (system instruction + TTL) and referenced from
+# every request, so the model no longer re-reads it as fresh input. Entries
+# are refreshed shortly before they expire. Models that refuse the cache (for
+# example because the prompt is below their minimum cacheable size) are
+# remembered for a while and get the inline prompt instead.
+CONTEXT_CACHE                  = False
+CONTEXT_CACHE_TTL_SECONDS      = 3600
+CONTEXT_CACHE_REFRESH_SECONDS  = 120    # recreate this long before expiry
+CONTEXT_CACHE_RETRY_SECONDS    = 600    # back-off after a failed create
+
+_context_cache_lock   = threading.Lock()
+_context_create_lock  = threading.Lock()
+_context_caches       = {}     # model -> {"name": str | None, "expires_at": float}
+_context_cache_stats  = {"created": 0, "reused": 0, "create_failed": 0, "invalidated": 0}
+
+
+def _context_cache_lookup(model: str):
+    # Returns (hit, name): hit is False when the entry is missing or stale.
+    with _context_cache_lock:
+        entry = _context_caches.get(model)
+        if entry is None or entry["expires_at"] - CONTEXT_CACHE_REFRESH_SECONDS <= time.time():
+            return False, None
+        if entry["name"] is not None:
+            _context_cache_stats["reused"] += 1
+        return True, entry["name"]
+
+
+def _context_cache_for(client, model: str):
+    hit, name = _context_cache_lookup(model)
+    if hit:
+        return name
+
+    with _context_create_lock:
+        hit, name = _context_cache_lookup(model)      # another thread may have won
+        if hit:
+            return name
+
+        try:
+            cache = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"pdf-extractor-{PROMPT_HASH}",
+                    system_instruction=PROMPT,
+                    ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                )
+            )
+        except Exception as e:
+            print(f"⚠️  [Context] Could not cache instructions for {model}: {str(e)[:120]}")
+            with _context_cache_lock:
+                _context_caches[model] = {"name": None, "expires_at": time.time() + CONTEXT_CACHE_RETRY_SECONDS}
+                _context_cache_stats["create_failed"] += 1
+            return None
+
+        with _context_cache_lock:
+            _context_caches[model] = {"name": cache.name, "expires_at": time.time() + CONTEXT_CACHE_TTL_SECONDS}
+            _context_cache_stats["created"] += 1
+        print(f"🧠 [Context] Cached instructions for {model} as {cache.name} (ttl={CONTEXT_CACHE_TTL_SECONDS}s).")
+        return cache.name
+
+
+def _is_context_cache_error(err, name: str) -> bool:
+    # Only a rejected cache reference (expired, deleted, or not ours) warrants
+    # dropping it. Quota, overload and timeout errors are the model's, and go
+    # to the normal retry/fallback path instead.
+    msg = str(err)
+    if not any(code in msg for code in ("NOT_FOUND", "PERMISSION_DENIED", "404", "403")):
+        return False
+    lowered = msg.lower()
+    return name in msg or "cachedcontent" in lowered or "cached content" in lowered
+
+
+def _invalidate_context_cache(model: str, name: str, err):
+    with _context_cache_lock:
+        entry = _context_caches.get(model)
+        if entry is not None and entry["name"] == name:
+            del _context_caches[model]
+        _context_cache_stats["invalidated"] += 1
+    print(f"♻️  [Context] Cached instructions {name} rejected ({str(err)[:80]}) — retrying with the inline prompt.")
+
+
+def get_context_cache_stats() -> dict:
+    now = time.time()
+    with _context_cache_lock:
+        stats = dict(_context_cache_stats)
+        stats["entries"] = {
+            model: {"name": entry["name"], "expires_in_s": round(entry["expires_at"] - now)}
+            for model, entry in _context_caches.items()
+        }
+    return stats
+
+
+def clear_context_caches(client=None):
+    with _context_cache_lock:
+        names = [entry["name"] for entry in _context_caches.values() if entry["name"]]
+        _context_caches.clear()
+    client = client or get_client()
+    for name in names:
+        try:
+            client.caches.delete(name=name)
+        except Exception as e:
+            print(f"⚠️  [Context] Could not delete {name}: {e}")
+
+
+def _generation_config(timeout=None, cached_content=None, model=None):
+    structured = _supports_schema(model)
+    return types.GenerateContentConfig(
+        temperature=0,
+        cached_content=cached_content,
+        response_mime_type="application/json" if structured else None,
+        response_schema=RESPONSE_SCHEMA if structured else None,
+        http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
+    )
+
+
+def _generate_stream(client, model, pdf_part, prompt, timeout):
+    # Yields response chunks. With context caching on, the request carries only
+    # the PDF and references the cached instructions; if the cache is rejected
+    # before the first chunk (expired or deleted server-side) the request is
+    # retried once with the inline prompt. Any other error is raised as usual.
+    cached_content = None
+    if CONTEXT_CACHE and prompt == PROMPT:
+        cached_content = _context_cache_for(client, model)
+
+    if cached_content:
+        stream = iter(client.models.generate_content_stream(
+            model=model,
+            contents=_build_contents(pdf_part, None),
+            config=_generation_config(timeout, cached_content, model)
+        ))
+        try:
+            first = next(stream)
+        except StopIteration:
+            return
+        except Exception as e:
+            if not _is_context_cache_error(e, cached_content):
+                raise
+            _invalidate_context_cache(model, cached_content, e)
+        else:
+            yield first
+            yield from stream
+            return
+
+    yield from client.models.generate_content_stream(
+        model=model,
+        contents=_build_contents(pdf_part, prompt),
+        config=_generation_config(timeout, model=model)
+    )
+
+
+# ── INCREMENTAL STREAM PARSER ─────────────────────────────────────────────────
+# Fed the model output chunk by chunk; returns each service object as soon as
+# its closing brace arrives. A service is any object at the top level or
+# directly inside the top-level array. Braces inside string values (and
+# escaped quotes) are ignored, and anything outside the JSON, like markdown
+# fences, is skipped. `services` keeps everything completed so far, so a
+# stream that gets cut off still leaves its finished objects behind.
+class _ServiceStreamParser:
+    __slots__ = ("services", "_stack", "_in_string", "_escape", "_pieces")
+
+    def __init__(self):
+        self.services   = []
+        self._stack     = []        # open containers: "{" or "["
+        self._in_string = False
+        self._escape    = False
+        self._pieces    = None      # text of the service currently being read
+
+    def feed(self, text: str) -> list:
+        completed = []
+        stack     = self._stack
+        start     = 0 if self._pieces is not None else None
+
+        for i, ch in enumerate(text):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                if stack:
+                    self._in_string = True
+            elif ch == "{" or ch == "[":
+                if ch == "{" and self._pieces is None and (not stack or stack == ["["]):
+                    self._pieces = []
+                    start = i
+                stack.append(ch)
+            elif ch == "}" or ch == "]":
+                if not stack:
+                    continue
+                stack.pop()
+                if ch == "}" and self._pieces is not None and (not stack or stack == ["["]):
+                    self._pieces.append(text[start:i + 1])
+                    try:
+                        obj = json.loads("".join(self._pieces))
+                    except json.JSONDecodeError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        completed.append(obj)
+                    self._pieces = None
+                    start = None
+
+        if self._pieces is not None and start is not None:
+            self._pieces.append(text[start:])
+
+        self.services.extend(completed)
+        return completed
+
+
+# ── RATE LIMITER ──────────────────────────────────────────────────────────────
+# One limiter per model, shared by every extraction in the process: a token
+# bucket caps the request rate and an AIMD window caps concurrent calls.
+# Quota errors (429 / RESOURCE_EXHAUSTED) halve both; overload errors (5xx,
+# UNAVAILABLE, timeouts) shrink the window by a quarter; each success widens
+# the window by 1/window and lets the rate recover. Callers wait briefly for a
+# slot instead of tripping the quota again, and retry the same model once
+# after a quota error before failing over.
+#
+# The quota is per API key, not per process. With share_rate_limits(path) (or
+# EXTRACT_RATE_LIMIT_DB set) the bucket, the window and the calls in flight
+# are kept in a SQLite file instead, so every process pointed at it — job
+# workers, CLI --processes — draws from one budget. Each process still waits
+# on its own lock and re-reads the shared state at least every 0.25s.
+RATE_LIMIT_RPS              = 5.0    # steady-state requests/second per model
+RATE_LIMIT_BURST            = 10     # token bucket size
+RATE_LIMIT_MIN_RPS          = 0.2
+AIMD_INITIAL_LIMIT          = 8      # concurrent calls per model
+AIMD_MIN_LIMIT              = 1
+AIMD_MAX_LIMIT              = 32
+RATE_LIMIT_MAX_WAIT_SECONDS = 10     # longest a call queues for a slot
+RATE_LIMIT_RETRIES          = 1      # same-model retries after a quota error
+RATE_LIMIT_DB               = os.environ.get("EXTRACT_RATE_LIMIT_DB") or None
+RATE_LIMIT_HOLDER_STALE_SECONDS = 120   # a process silent this long holds no slots
+
+_QUOTA_ERRORS    = ("429", "RESOURCE_EXHAUSTED")
+_OVERLOAD_ERRORS = ("503", "500", "UNAVAILABLE", "INTERNAL", "TIMEOUT")
+
+
+def _is_quota_error(err) -> bool:
+    return bool(err) and any(code in err for code in _QUOTA_ERRORS)
+
+
+def _outcome(err, cancelled: bool = False) -> str:
+    if _is_quota_error(err):
+        return "quota"
+    if err and any(code in err for code in _OVERLOAD_ERRORS):
+        return "overload"
+    if err or cancelled:
+        return "neutral"        # non-retryable errors and aborts say nothing about load
+    return "ok"
+
+
+class _SharedLimits:
+    # Limiter state in a SQLite file shared between processes: one row per
+    # model for the bucket and window, one per (model, process) for its calls
+    # in flight. A process that dies stops refreshing its row, which is
+    # ignored once older than RATE_LIMIT_HOLDER_STALE_SECONDS.
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rate_limits (
+        model TEXT PRIMARY KEY, rate REAL, tokens REAL, refilled_at REAL, window REAL
+    );
+    CREATE TABLE IF NOT EXISTS rate_limit_holders (
+        model TEXT, owner TEXT, in_flight INTEGER, updated_at REAL, PRIMARY KEY (model, owner)
+    );
+    """
+
+    def __init__(self, path: str):
+        self.path   = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self._SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def sync(self, limiter, update):
+        # Loads the shared state into `limiter`, runs update() and writes the
+        # result back, all in one write transaction.
+        conn  = self._conn()
+        owner = str(os.getpid())
+        now   = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT rate, tokens, refilled_at, window FROM rate_limits WHERE model = ?", (limiter.model,)
+            ).fetchone()
+            if row is not None:
+                limiter.rate, limiter.tokens, limiter.refilled_at, limiter.limit = row
+            conn.execute("DELETE FROM rate_limit_holders WHERE updated_at < ?",
+                         (now - RATE_LIMIT_HOLDER_STALE_SECONDS,))
+            limiter.others = conn.execute(
+                "SELECT COALESCE(SUM(in_flight), 0) FROM rate_limit_holders WHERE model = ? AND owner != ?",
+                (limiter.model, owner)
+            ).fetchone()[0]
+            result = update()
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?)",
+                (limiter.model, limiter.rate, limiter.tokens, limiter.refilled_at, limiter.limit)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_holders VALUES (?, ?, ?, ?)",
+                (limiter.model, owner, limiter.in_flight, now)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM rate_limits")
+        conn.execute("DELETE FROM rate_limit_holders")
+
+
+class _ModelLimiter:
+    __slots__ = ("model", "cond", "shared", "rate", "tokens", "refilled_at", "limit", "in_flight", "others",
+                 "stats")
+
+    def __init__(self, model: str, shared=None):
+        self.model       = model
+        self.cond        = threading.Condition()
+        self.shared      = shared       # _SharedLimits, or None for process-local state
+        self.rate        = RATE_LIMIT_RPS
+        self.tokens      = float(RATE_LIMIT_BURST)
+        self.refilled_at = time.time()
+        self.limit       = float(AIMD_INITIAL_LIMIT)
+        self.in_flight   = 0            # this process's calls
+        self.others      = 0            # other processes' calls (shared state only)
+        self.stats       = {"acquired": 0, "throttled": 0, "throttle_seconds": 0.0, "wait_timeouts": 0,
+                            "ok": 0, "quota": 0, "overload": 0, "neutral": 0}
+
+    def _take(self):
+        # Under the lock: takes a slot and returns 0, or returns how long to
+        # wait for the next token (None = wait for a running call to finish).
+        if self.shared is not None:
+            return self.shared.sync(self, self._take_local)
+        return self._take_local()
+
+    def _take_local(self):
+        now = time.time()
+        self.tokens = min(RATE_LIMIT_BURST, self.tokens + max(now - self.refilled_at, 0) * self.rate)
+        self.refilled_at = now
+        if self.in_flight + self.others >= int(self.limit):
+            return None
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens    -= 1
+        self.in_flight += 1
+        self.stats["acquired"] += 1
+        return 0
+
+    def try_acquire(self):
+        # Non-blocking, for the async path: (acquired, suggested wait).
+        with self.cond:
+            wait = self._take()
+        return wait == 0, wait
+
+    def acquire(self, max_wait: float = RATE_LIMIT_MAX_WAIT_SECONDS, cancel=None) -> bool:
+        started  = time.monotonic()
+        deadline = started + max_wait
+        with self.cond:
+            while True:
+                wait = self._take()
+                if wait == 0:
+                    self.record_wait(time.monotonic() - started)
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (cancel is not None and cancel.is_set()):
+                    self.record_wait(time.monotonic() - started, timed_out=remaining <= 0)
+                    return False
+                # Wake for a token, a released slot, or (every 0.25s) a cancel.
+                self.cond.wait(min(remaining, wait if wait is not None else remaining, 0.25))
+
+    def record_wait(self, waited: float, timed_out: bool = False):
+        if waited > 0.001:
+            self.stats["throttled"] += 1
+            self.stats["throttle_seconds"] += waited
+        if timed_out:
+            self.stats["wait_timeouts"] += 1
+
+    def release(self, outcome: str):
+        with self.cond:
+            if self.shared is not None:
+                self.shared.sync(self, lambda: self._release_local(outcome))
+            else:
+                self._release_local(outcome)
+            self.cond.notify_all()
+
+    def _release_local(self, outcome: str):
+        self.in_flight -= 1
+        self.stats[outcome] += 1
+        if outcome == "quota":
+            self.limit  = max(AIMD_MIN_LIMIT, self.limit / 2)
+            self.rate   = max(RATE_LIMIT_MIN_RPS, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+        elif outcome == "overload":
+            self.limit = max(AIMD_MIN_LIMIT, self.limit * 0.75)
+        elif outcome == "ok":
+            self.limit = min(AIMD_MAX_LIMIT, self.limit + 1 / self.limit)
+            self.rate  = min(RATE_LIMIT_RPS, self.rate + RATE_LIMIT_RPS / 10)
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return {
+                "limit":     int(self.limit),
+                "in_flight": self.in_flight,
+                "in_flight_elsewhere": self.others,
+                "rate_rps":  round(self.rate, 3),
+                "tokens":    round(min(RATE_LIMIT_BURST, self.tokens + max(time.time() - self.refilled_at, 0) * self.rate), 2),
+                "shared":    self.shared is not None,
+                **self.stats,
+                "throttle_seconds": round(self.stats["throttle_seconds"], 3),
+            }
+
+
+_limiters_lock = threading.Lock()
+_limiters      = {}
+_shared_limits = None
+
+
+def _limiter(model: str) -> _ModelLimiter:
+    global _shared_limits
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            if RATE_LIMIT_DB and (_shared_limits is None or _shared_limits.path != RATE_LIMIT_DB):
+                _shared_limits = _SharedLimits(RATE_LIMIT_DB)
+            limiter = _limiters[model] = _ModelLimiter(model, _shared_limits if RATE_LIMIT_DB else None)
+        return limiter
+
+
+def share_rate_limits(path):
+    # Keeps limiter state in the SQLite file at `path` (None = per process).
+    # Also usable as a ProcessPoolExecutor initializer.
+    global RATE_LIMIT_DB
+    with _limiters_lock:
+        RATE_LIMIT_DB = path
+        _limiters.clear()
+    if path:
+        print(f"🚦 [Limiter] Sharing rate limits through {path}")
+
+
+def get_rate_limiter_stats() -> dict:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.model: limiter.snapshot() for limiter in limiters}
+
+
+def reset_rate_limiters():
+    with _limiters_lock:
+        _limiters.clear()
+        shared = _shared_limits if RATE_LIMIT_DB else None
+    if shared is not None:
+        shared.clear()
+
+
+# ── MODEL ROUTER ──────────────────────────────────────────────────────────────
+# Orders the fallback chain by live health instead of walking get_models()
+# as written. Each model keeps EWMA latency (of successful calls) and
+# time-to-first-chunk plus the call and parse outcomes of the last
+# ROUTER_WINDOW_SECONDS, and is ranked by expected seconds per usable result
+# (latency ÷ success rate); old failures age out, so a model that was routed
+# around gets traffic again once things settle. A model that keeps failing opens
+# its circuit breaker and drops to the back of the chain; after a cool-down it
+# goes half-open and one extraction at a time carries it as a probe, behind the
+# healthy models so a real document only waits on it once they have failed. The
+# probe closes the breaker on success or re-opens it for twice as long on
+# failure. Models without samples rank at ROUTER_PRIOR_SECONDS, keeping their
+# configured order, and success and parse rates only count from
+# ROUTER_MIN_SAMPLES outcomes on — one early 503 must not send the primary model
+# behind every untried one.
+DYNAMIC_ROUTING            = True
+ROUTER_WINDOW              = 20     # outcomes kept per model…
+ROUTER_WINDOW_SECONDS      = 300    # …for at most this long
+ROUTER_EWMA_ALPHA          = 0.3
+ROUTER_PRIOR_SECONDS       = 15.0
+ROUTER_MIN_SAMPLES         = 4      # before a failure rate can trip the breaker or rank a model
+ROUTER_FAILURE_THRESHOLD   = 0.5
+ROUTER_CONSECUTIVE_FAILURES = 3
+ROUTER_OPEN_SECONDS        = 60     # first cool-down; doubles per re-trip
+ROUTER_MAX_OPEN_SECONDS    = 600
+
+
+class _ModelHealth:
+    __slots__ = ("model", "rank", "latency", "ttft", "calls", "parses", "consecutive",
+                 "state", "open_until", "cooldown", "trips", "probe_until")
+
+    def __init__(self, model: str, rank: int):
+        self.model       = model
+        self.rank        = rank                         # position in get_models()
+        self.latency     = None                         # EWMA seconds per call
+        self.ttft        = None                         # EWMA seconds to first chunk
+        self.calls       = deque(maxlen=ROUTER_WINDOW)  # (at, call succeeded)
+        self.parses      = deque(maxlen=ROUTER_WINDOW)  # (at, response parsed)
+        self.consecutive = 0
+        self.state       = "closed"
+        self.open_until  = 0.0
+        self.cooldown    = ROUTER_OPEN_SECONDS
+        self.trips       = 0
+        self.probe_until = 0.0                          # a probe is out until then
+
+    def _recent(self, outcomes):
+        cutoff = time.monotonic() - ROUTER_WINDOW_SECONDS
+        while outcomes and outcomes[0][0] < cutoff:
+            outcomes.popleft()
+        return [ok for _at, ok in outcomes]
+
+    def success_rate(self):
+        calls = self._recent(self.calls)
+        return sum(calls) / len(calls) if calls else None
+
+    def parse_failure_rate(self):
+        parses = self._recent(self.parses)
+        return 1 - sum(parses) / len(parses) if parses else None
+
+    def score(self) -> float:
+        # Under _router_lock: _recent() trims the outcome deques.
+        latency = self.latency if self.latency is not None else ROUTER_PRIOR_SECONDS
+        calls   = self._recent(self.calls)
+        parses  = self._recent(self.parses)
+        usable  = 1.0
+        if len(calls) >= ROUTER_MIN_SAMPLES:
+            usable *= sum(calls) / len(calls)
+        if len(parses) >= ROUTER_MIN_SAMPLES:
+            usable *= sum(parses) / len(parses)
+        return latency / max(usable, 0.05)
+
+
+_router_lock = threading.Lock()
+_health      = {}
+
+
+def _model_health(model: str) -> _ModelHealth:
+    # Under _router_lock.
+    health = _health.get(model)
+    if health is None:
+        models = get_models()
+        rank = models.index(model) if model in models else len(models)
+        health = _health[model] = _ModelHealth(model, rank)
+    return health
+
+
+def _ewma(current, sample):
+    return sample if current is None else current + ROUTER_EWMA_ALPHA * (sample - current)
+
+
+def _trip(health: _ModelHealth, now: float, reason: str):
+    if health.state == "half_open":
+        health.cooldown = min(health.cooldown * 2, ROUTER_MAX_OPEN_SECONDS)
+    health.state       = "open"
+    health.open_until  = now + health.cooldown
+    health.probe_until = 0.0
+    health.trips      += 1
+    print(f"🔌 [Router] Circuit open for {health.model} ({reason}) — skipping it for {health.cooldown}s.")
+
+
+def route_models() -> list:
+    # The fallback chain for one extraction, best first.
+    if not DYNAMIC_ROUTING:
+        return list(get_models())
+
+    now = time.monotonic()
+    with _router_lock:
+        healths = [_model_health(m) for m in get_models()]
+        probe, healthy, held = None, [], []
+        for h in healths:
+            if h.state == "open" and now >= h.open_until:
+                h.state = "half_open"
+            if h.state == "half_open" and probe is None and now >= h.probe_until:
+                h.probe_until = now + 2 * MODEL_TIMEOUT_SECONDS
+                probe = h
+            elif h.state == "closed":
+                healthy.append(h)
+            else:
+                held.append(h)
+
+        healthy.sort(key=lambda h: (h.score(), h.rank))
+        held.sort(key=lambda h: (h.open_until, h.rank))
+    order = healthy + ([probe] if probe else []) + held
+    if probe is not None:
+        print(f"🩺 [Router] {probe.model} is half-open — probing it after the healthy models.")
+    return [h.model for h in order]
+
+
+def _router_record_call(model: str, outcome: str, seconds: float, ttft=None):
+    # outcome as from _outcome(). Quota errors belong to the rate limiter and
+    # aborts or bad requests say nothing about the model, so only "ok" and
+    # "overload" (5xx, UNAVAILABLE, timeouts) move the health score.
+    if outcome not in ("ok", "overload"):
+        return
+    ok  = outcome == "ok"
+    now = time.monotonic()
+    with _router_lock:
+        h = _model_health(model)
+        if ok:
+            h.latency = _ewma(h.latency, seconds)
+        if ttft is not None:
+            h.ttft = _ewma(h.ttft, ttft)
+        h.calls.append((now, ok))
+        h.consecutive = 0 if ok else h.consecutive + 1
+
+        if h.state == "half_open":
+            if ok:
+                h.state, h.cooldown, h.probe_until = "closed", ROUTER_OPEN_SECONDS, 0.0
+                h.calls.clear()
+                h.calls.append((now, True))
+                print(f"🔌 [Router] Circuit closed for {model} — probe succeeded in {seconds:.1f}s.")
+            else:
+                _trip(h, now, "probe failed")
+        elif h.state == "closed" and not ok:
+            calls = h._recent(h.calls)
+            failure_rate = 1 - sum(calls) / len(calls)
+            if h.consecutive >= ROUTER_CONSECUTIVE_FAILURES:
+                _trip(h, now, f"{h.consecutive} failures in a row")
+            elif len(calls) >= ROUTER_MIN_SAMPLES and failure_rate >= ROUTER_FAILURE_THRESHOLD:
+                _trip(h, now, f"{failure_rate:.0%} of the last {len(calls)} calls failed")
+
+
+def _router_record_parse(model, ok: bool):
+    if model is None:
+        return
+    with _router_lock:
+        _model_health(model).parses.append((time.monotonic(), ok))
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+def get_router_stats() -> dict:
+    now = time.monotonic()
+    with _router_lock:
+        healths = [_model_health(m) for m in get_models()]
+        models = {
+            h.model: {
+                "state":              h.state,
+                "score":              round(h.score(), 3),
+                "latency_s":          _round(h.latency),
+                "first_chunk_s":      _round(h.ttft),
+                "success_rate":       _round(h.success_rate()),
+                "parse_failure_rate": _round(h.parse_failure_rate()),
+                "samples":            len(h._recent(h.calls)),
+                "consecutive_failures": h.consecutive,
+                "trips":              h.trips,
+                "retry_in_s":         round(max(h.open_until - now, 0), 1) if h.state == "open" else None,
+            }
+            for h in healths
+        }
+    order = sorted(models, key=lambda m: (models[m]["state"] != "closed", models[m]["score"]))
+    return {"order": order if DYNAMIC_ROUTING else list(get_models()), "models": models}
+
+
+def reset_router():
+    with _router_lock:
+        _health.clear()
+
+
+# ── MODEL CALL POOL ───────────────────────────────────────────────────────────
+# Every streaming model call runs on one bounded pool, so the number of live
+# generations in the process never exceeds MAX_LIVE_MODEL_CALLS. A timed-out
+# or losing call is aborted rather than left running: its cancel flag stops
+# consumption at the next chunk and closes the stream, and the per-request
+# HTTP timeout unblocks a read that never receives another chunk. A slot only
+# frees up once the call has actually stopped.
+MAX_LIVE_MODEL_CALLS = 8
+CANCEL_GRACE_SECONDS = 5     # how long cleanup waits for aborted calls to stop
+
+_pool_lock  = threading.Lock()
+_model_pool = None
+_pool_stats = {
+    "submitted": 0, "live": 0, "peak_live": 0, "completed": 0,
+    "timed_out": 0, "cancelled": 0, "rejected": 0,
+}
+
+
+def _get_model_pool() -> ThreadPoolExecutor:
+    global _model_pool
+    with _pool_lock:
+        if _model_pool is None:
+            _model_pool = ThreadPoolExecutor(
+                max_workers=MAX_LIVE_MODEL_CALLS,
+                thread_name_prefix="gemini-call"
+            )
+        return _model_pool
+
+
+def configure_model_pool(max_live_calls: int):
+    global _model_pool, MAX_LIVE_MODEL_CALLS
+    with _pool_lock:
+        old, _model_pool = _model_pool, None
+        MAX_LIVE_MODEL_CALLS = max(1, int(max_live_calls))
+    if old is not None:
+        old.shutdown(wait=False)
+    print(f"🧵 [Pool] Live model call limit set to {MAX_LIVE_MODEL_CALLS}.")
+
+
+def _pool_record(**increments):
+    with _pool_lock:
+        for k, v in increments.items():
+            _pool_stats[k] += v
+        _pool_stats["peak_live"] = max(_pool_stats["peak_live"], _pool_stats["live"])
+
+
+def get_model_pool_stats() -> dict:
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    stats["limit"]  = MAX_LIVE_MODEL_CALLS
+    stats["queued"] = stats["submitted"] - stats["completed"] - stats["live"] - stats["rejected"]
+    return stats
+
+
+# usage_metadata fields exported as tokens_total{kind=…}.
+_TOKEN_KINDS = {
+    "prompt": "prompt_token_count",
+    "cached": "cached_content_token_count",
+    "output": "candidates_token_count",
+    "thinking": "thoughts_token_count",
+}
+
+
+def _call_finished(model, outcome, seconds, first_chunk=None, usage=None):
+    # One model call has stopped: feed the router and the metrics.
+    _router_record_call(model, outcome, seconds, first_chunk)
+    metrics.inc("model_attempts_total", model=model, outcome=outcome)
+    metrics.observe("stage_seconds", seconds, stage="stream", model=model)
+    if first_chunk is not None:
+        metrics.observe("stage_seconds", first_chunk, stage="first_chunk", model=model)
+    if usage is not None:
+        for kind, field in _TOKEN_KINDS.items():
+            count = getattr(usage, field, None)
+            if count:
+                metrics.inc("tokens_total", count, model=model, kind=kind)
+
+
+def _start_stream(client, model, pdf_part, prompt, timeout=MODEL_TIMEOUT_SECONDS, on_done=None, on_service=None):
+    # Schedules one generate_content_stream call on the model pool and returns
+    # its handle. Set call["cancel"] to abort it; call["started"] and
+    # call["first_chunk"] are set as the call progresses; on_service(model,
+    # service) fires for each service as it completes; on_done(call) fires
+    # once the call has stopped for whatever reason.
+    parser = _ServiceStreamParser()
+    call = {
+        "model": model,
+        "text": None,
+        "error": None,
+        "services": parser.services,
+        "cancel": threading.Event(),
+        "started": threading.Event(),
+        "first_chunk": threading.Event(),
+        "first_chunk_at": None,
+        "cancelled": False,
+        "timed_out": False,
+        "future": None,
+    }
 
     def _stream():
+        if call["cancel"].is_set():
+            call["cancelled"] = True
+            _pool_record(rejected=1)
+            if on_done is not None:
+                on_done(call)
+            return
+
+        # Queue for this model's rate limiter; a call that cannot get a slot
+        # in time fails with a quota-class error so callers fail over.
+        limiter = _limiter(model)
+        if not limiter.acquire(cancel=call["cancel"]):
+            if call["cancel"].is_set():
+                call["cancelled"] = True
+            else:
+                call["error"] = f"RESOURCE_EXHAUSTED: no {model} rate-limit slot within {RATE_LIMIT_MAX_WAIT_SECONDS}s"
+            _pool_record(rejected=1)
+            call["started"].set()
+            if on_done is not None:
+                on_done(call)
+            return
+
+        _pool_record(live=1)
+        began = time.monotonic()
+        call["started"].set()
+        stream, usage = None, None
         try:
             chunks = []
-            for chunk in client.models.generate_content_stream(
-                model=model,
-                contents=[
-                    types.Content(
-                        role="user",
-                        parts=[
-                            types.Part.from_uri(
-                                file_uri=uploaded_file.uri,
-                                mime_type="application/pdf"
-                            ),
-                            types.Part.from_text(text=prompt),
-                        ]
-                    )
-                ],
-                config=types.GenerateContentConfig(temperature=0)
-            ):
+            stream = _generate_stream(client, model, pdf_part, prompt, timeout)
+            for chunk in stream:
+                if call["first_chunk_at"] is None:
+                    call["first_chunk_at"] = time.monotonic()
+                    call["first_chunk"].set()
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if call["cancel"].is_set():
+                    call["cancelled"] = True
+                    break
                 if chunk.text:
                     chunks.append(chunk.text)
-            result["text"] = "".join(chunks).strip()
+                    for service in parser.feed(chunk.text):
+                        if on_service is not None:
+                            on_service(model, service)
+            call["text"] = "".join(chunks).strip()
         except Exception as e:
-            result["error"] = str(e)
+            call["error"] = str(e)
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+            # A call aborted for running past its timeout counts as overload,
+            # not as a neutral cancel.
+            outcome = "overload" if call["timed_out"] else _outcome(call["error"], call["cancelled"])
+            limiter.release(outcome)
+            first = call["first_chunk_at"]
+            _call_finished(model, outcome, time.monotonic() - began, first - began if first else None, usage)
+            _pool_record(live=-1, completed=1, cancelled=int(call["cancelled"]))
+            if on_done is not None:
+                on_done(call)
+
+    _pool_record(submitted=1)
+    call["future"] = _get_model_pool().submit(_stream)
+    return call
+
+
+def _abort_call(call):
+    call["cancel"].set()
+    if call["future"].cancel():     # never left the queue — dropped outright
+        _pool_record(rejected=1)
+
+
+def _wait_for_calls(calls, timeout=CANCEL_GRACE_SECONDS):
+    futures_ = [c["future"] for c in calls if c["future"] is not None]
+    if not futures_:
+        return
+    _done, still_running = futures.wait(futures_, timeout=timeout)
+    if still_running:
+        print(f"⚠️  [Pool] {len(still_running)} aborted model call(s) still winding down.")
+
+
+def _release_upload(client, uploaded_file, calls):
+    # Deletes the uploaded file once no call is reading it any more. Aborted
+    # calls only notice their cancel flag between chunks, so if any are still
+    # running the wait and the delete move to a background thread rather than
+    # holding up the result. Inline PDFs have nothing to release.
+    if uploaded_file is None:
+        return
+    if all(c["future"] is None or c["future"].done() for c in calls):
+        _delete_file(client, uploaded_file)
+        return
+
+    def _cleanup():
+        _wait_for_calls(calls)
+        _delete_file(client, uploaded_file)
+
+    threading.Thread(target=_cleanup, name="gemini-cleanup", daemon=True).start()
+
 
-    thread = threading.Thread(target=_stream, daemon=True)
-    thread.start()
-    thread.join(timeout=timeout)
+def _salvage_partial(error: dict, service_lists) -> dict:
+    # When every attempt failed, attach the longest run of services that a
+    # cut-off stream had already completed as error["partial"]. The result is
+    # still an error: callers decide whether an incomplete list is usable.
+    partial = max((list(services) for services in service_lists), key=len, default=[])
+    if not partial:
+        return error
+    print(f"♻️  [Stream] {error['error']} — {len(partial)} service(s) completed before the stream was cut off.")
+    return dict(error, partial=partial)
 
-    if thread.is_alive():
+
+def _call_streaming_with_timeout(client, model, pdf_part, prompt, timeout=MODEL_TIMEOUT_SECONDS, inflight=None, on_service=None):
+    call = _start_stream(client, model, pdf_part, prompt, timeout=timeout, on_service=on_service)
+    if inflight is not None:
+        inflight.append(call)
+
+    # Time spent waiting for a free pool slot is bounded separately, so a busy
+    # pool does not eat into the model's own timeout.
+    if not call["started"].wait(timeout=timeout):
+        _abort_call(call)
+        _pool_record(timed_out=1)
+        return None, f"TIMEOUT after {timeout}s waiting for a model call slot"
+
+    try:
+        call["future"].result(timeout=timeout)
+    except futures.TimeoutError:
+        call["timed_out"] = True
+        _abort_call(call)
+        _pool_record(timed_out=1)
         return None, f"TIMEOUT after {timeout}s"
 
-    return result["text"], result["error"]
+    return call["text"], call["error"]
+
+
+# ── HEDGED REQUESTS ───────────────────────────────────────────────────────────
+# Optional alternative to the strictly sequential fallback: if the newest model
+# attempt has not produced its first chunk within HEDGE_DELAY_SECONDS, the next
+# model in the routed chain is launched in parallel against the same PDF part
+# (uploaded file or inline bytes). The first attempt returning parseable JSON wins; the rest are cancelled.
+HEDGE_DELAY_SECONDS = None   # None = hedging off (sequential fallback)
+
+_hedge_lock  = threading.Lock()
+_hedge_stats = {}
+
+
+def _hedge_record(model: str, **increments):
+    with _hedge_lock:
+        stats = _hedge_stats.setdefault(model, {
+            "launched": 0, "wins": 0, "cancelled": 0, "failed": 0,
+            "first_chunk_count": 0, "first_chunk_seconds": 0.0,
+            "win_seconds": 0.0,
+        })
+        for k, v in increments.items():
+            stats[k] += v
+
+
+def get_hedge_stats() -> dict:
+    with _hedge_lock:
+        snapshot = {model: dict(stats) for model, stats in _hedge_stats.items()}
+
+    report = {}
+    for model, stats in snapshot.items():
+        fc, wins = stats["first_chunk_count"], stats["wins"]
+        report[model] = {
+            "launched":  stats["launched"],
+            "wins":      wins,
+            "cancelled": stats["cancelled"],
+            "failed":    stats["failed"],
+            "win_rate":  round(wins / stats["launched"], 3) if stats["launched"] else 0.0,
+            "avg_first_chunk_s": round(stats["first_chunk_seconds"] / fc, 3) if fc else None,
+            "avg_win_latency_s": round(stats["win_seconds"] / wins, 3) if wins else None,
+        }
+    return report
+
+
+def _hedged_generate(client, pdf_part, prompt, hedge_delay, timeout=MODEL_TIMEOUT_SECONDS, inflight=None, on_service=None):
+    # Returns (model, services, None) on success or (None, None, error_dict).
+    finished = queue.Queue()
+    attempts = []
+    models   = route_models()
+    last_err, last_cleaned = None, None
+
+    def _launch():
+        if attempts:
+            metrics.inc("fallbacks_total", model=attempts[-1]["model"], reason="hedge")
+        model   = models[len(attempts)]
+        attempt = {"model": model, "started": time.monotonic(), "call": None, "done": False}
+        attempts.append(attempt)
+        _hedge_record(model, launched=1)
+        print(f"\n🚀 [Hedge] Launching {model} ({len(attempts)}/{len(models)}, timeout={timeout}s)")
+        attempt["call"] = _start_stream(
+            client, model, pdf_part, prompt, timeout=timeout,
+            on_done=lambda call: finished.put((attempt, call)),
+            on_service=on_service,
+        )
+        if inflight is not None:
+            inflight.append(attempt["call"])
+
+    def _finish(a, **increments):
+        a["done"] = True
+        first_chunk_at = a["call"]["first_chunk_at"]
+        if first_chunk_at is not None:
+            increments.update(first_chunk_count=1, first_chunk_seconds=first_chunk_at - a["started"])
+        _hedge_record(a["model"], **increments)
+
+    def _cancel_all(reason: str):
+        for a in attempts:
+            if not a["done"]:
+                _abort_call(a["call"])
+                _finish(a, cancelled=1)
+                print(f"✋ [Hedge] Cancelled {a['model']} ({reason}).")
+
+    _launch()
+    while True:
+        now  = time.monotonic()
+        live = [a for a in attempts if not a["done"]]
+        more = len(attempts) < len(models)
+        if not live:
+            if not more:
+                break
+            _launch()
+            continue
+
+        # Wake up for the next hedge launch or the earliest attempt deadline.
+        wake_at = min(a["started"] + timeout for a in live)
+        newest  = attempts[-1]
+        if more and not newest["done"] and not newest["call"]["first_chunk"].is_set():
+            wake_at = min(wake_at, newest["started"] + hedge_delay)
+
+        try:
+            attempt, call = finished.get(timeout=max(wake_at - now, 0.05))
+        except queue.Empty:
+            now = time.monotonic()
+            for a in live:
+                if now >= a["started"] + timeout:
+                    a["call"]["timed_out"] = True
+                    _abort_call(a["call"])
+                    _pool_record(timed_out=1)
+                    _finish(a, failed=1)
+                    last_err = f"TIMEOUT after {timeout}s"
+                    print(f"⏰ [Hedge] {a['model']} timed out.")
+            newest = attempts[-1]
+            if (more and not newest["done"] and not newest["call"]["first_chunk"].is_set()
+                    and now >= newest["started"] + hedge_delay):
+                print(f"🐢 [Hedge] No first chunk from {newest['model']} after {hedge_delay}s — hedging.")
+                _launch()
+            continue
+
+        if attempt["done"]:
+            continue          # already timed out or cancelled
+        model = attempt["model"]
+
+        if call["error"]:
+            _finish(attempt, failed=1)
+            last_err = call["error"]
+            if not _is_retryable(last_err):
+                print(f"💀 [Hedge] Non-retryable error on {model}: {last_err}")
+                _cancel_all("non-retryable error elsewhere")
+                return None, None, {"error": "model_call_failed", "detail": last_err}
+            print(f"⚠️  [Hedge] {model} failed: {last_err[:120]}")
+            continue
+
+        print(f"✅ [Hedge] Got response from: {model}")
+        services, cleaned = _parse_response(call["text"] or "", model)
+        if services:
+            _finish(attempt, wins=1, win_seconds=time.monotonic() - attempt["started"])
+            _cancel_all(f"{model} won")
+            return model, services, None
+
+        _finish(attempt, failed=1)
+        last_cleaned = cleaned
+        if len(attempts) < len(models) or any(not a["done"] for a in attempts):
+            _parse_record(model, retried=1)
+        print(f"💥 [Parser] Repair failed on {model}.")
+
+    if last_cleaned is not None:
+        return None, None, {"error": "invalid_json", "raw": last_cleaned, "detail": "Repair failed on all models."}
+    return None, None, {"error": "all_models_failed", "detail": last_err or "Exhausted all models."}
 
 
 # ── JSON REPAIR ───────────────────────────────────────────────────────────────
+# Single forward pass: complete elements of the top-level array are decoded in
+# place with the C scanner (raw_decode), so every byte of them is read once
+# and braces or brackets inside strings never confuse the split. Only the
+# text from the first element that fails to decode is walked by _scan_json,
+# a string- and escape-aware scanner that finds any complete objects after a
+# malformed one and the containers left open by a truncated last object,
+# which are then closed in the right nesting order.
+_JSON_START   = re.compile(r"[\[{]")
+_JSON_GAP     = re.compile(r"[\s,]*")
+_JSON_TOKENS  = re.compile(r'[{}\[\]"\\]')
+_DANGLING_KEY = re.compile(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+_json_decoder = json.JSONDecoder()
+
+
+def _scan_json(text: str):
+    # Returns (spans of complete service objects, open containers, in_string).
+    # As in _ServiceStreamParser, a service is an object at the top level or
+    # directly inside a top-level array — prose like "[the]" before the JSON
+    # can leave the scan starting outside the array that holds them.
+    spans, stack = [], []
+    in_string, skip_to, start = False, -1, None
+
+    for m in _JSON_TOKENS.finditer(text):
+        i = m.start()
+        if i < skip_to:
+            continue
+        ch = text[i]
+
+        if in_string:
+            if ch == "\\":
+                skip_to = i + 2          # the escaped character is never structural
+            elif ch == '"':
+                in_string = False
+            continue
+
+        if ch == '"':
+            if stack:
+                in_string = True
+        elif ch == "{" or ch == "[":
+            if ch == "{" and start is None and (not stack or stack == ["["]):
+                start = i
+            stack.append(ch)
+        elif ch == "}" or ch == "]":
+            if not stack:
+                continue
+            stack.pop()
+            if ch == "}" and start is not None and (not stack or stack == ["["]):
+                spans.append((start, i + 1))
+                start = None
+
+    return spans, stack, in_string
+
+
+def _close_truncated(tail: str):
+    _spans, stack, in_string = _scan_json(tail)
+    if not stack:
+        return None
+
+    attempt = tail.rstrip()
+    if in_string:
+        attempt += '"'
+    if stack[-1] == "{":
+        attempt = _DANGLING_KEY.sub(r"\1", attempt)      # drop a key with no value
+    attempt = attempt.rstrip(", \t\r\n:")
+    attempt += "".join("}" if opener == "{" else "]" for opener in reversed(stack))
+
+    try:
+        return json.loads(attempt)
+    except json.JSONDecodeError:
+        return None
+
+
+def _salvage_json(raw: str):
+    # Returns (services, how) or (None, None); how is "salvage" when only
+    # complete objects were kept, "bracket-close" when a truncated last
+    # object was closed and kept as well.
+    m = _JSON_START.search(raw)
+    if m is None:
+        return None, None
+
+    objects, n = [], len(raw)
+    i = m.end() if m.group() == "[" else m.start()
+
+    while True:
+        i = _JSON_GAP.match(raw, i).end()
+        if i >= n or raw[i] == "]":
+            return (objects, "salvage") if objects else (None, None)
+        try:
+            obj, i = _json_decoder.raw_decode(raw, i)
+        except json.JSONDecodeError:
+            break
+        if isinstance(obj, dict):
+            objects.append(obj)
+
+    rest = raw[i:]
+    spans, _stack, _in_string = _scan_json(rest)
+    for a, b in spans:
+        try:
+            objects.append(json.loads(rest[a:b]))
+        except json.JSONDecodeError:
+            pass
+
+    tail = rest[spans[-1][1]:] if spans else rest
+    tail = tail[tail.find("{"):] if "{" in tail else ""
+    last = _close_truncated(tail) if tail else None
+    if isinstance(last, dict):
+        objects.append(last)
+        return objects, "bracket-close"
+
+    return (objects, "salvage") if objects else (None, None)
+
+
 def _repair_json(raw: str) -> list | None:
 
     try:
@@ -228,146 +2053,830 @@ def _repair_json(raw: str) -> list | None:
     except ImportError:
         pass
 
-    print("🔧 [Repair] Attempting bracket-close repair...")
-    attempt = raw.rstrip()
-    if attempt.endswith(","):
-        attempt = attempt[:-1]
-    attempt += "}" * max(attempt.count("{") - attempt.count("}"), 0)
-    attempt += "]" * max(attempt.count("[") - attempt.count("]"), 0)
+    services, how = _salvage_json(raw)
+    if services is None:
+        return None
+
+    if how == "bracket-close":
+        print(f"🔧 [Repair] Bracket-close succeeded — {len(services)} service(s).")
+    else:
+        print(f"🔧 [Repair] Salvaged {len(services)} object(s).")
+    return services
+
+
+# ── PAGE PRUNING ──────────────────────────────────────────────────────────────
+# Optional local pre-pass before upload: extract each page's text, score it for
+# the kind of content SERVICE_TEMPLATE asks for (services, directions, prices,
+# policies) and send the model a reduced PDF with only the relevant pages.
+# Gemini bills every PDF page as an image, so input tokens — and generation
+# latency — scale with page count. Needs pypdf; without it PDFs are sent whole.
+PRUNE_PAGES          = False   # opt-in; can drop content the scorer misses
+PRUNE_MIN_PAGES      = 4       # shorter documents are always sent whole
+PRUNE_MIN_SCORE      = 3       # pages scoring below this are dropped
+PRUNE_CONTEXT_PAGES  = 1       # also keep this many neighbours of a kept page
+TOKENS_PER_PDF_PAGE  = 258
+
+_PRUNE_STOPWORDS = {
+    "of", "per", "no", "with", "inside", "100%", "pieces", "hour", "type",
+    "name", "title", "details", "category", "point",
+}
+_PRUNE_KEYWORDS  = {
+    word
+    for key in [*SERVICE_TEMPLATE, *SERVICE_TEMPLATE["fast_track"],
+                *SERVICE_TEMPLATE["fast_track"]["arrival"],
+                *SERVICE_TEMPLATE["fast_track"]["departure"]]
+    for word in key.lower().split("_")
+    if word and word not in _PRUNE_STOPWORDS
+} | {
+    "price", "prices", "rate", "rates", "tariff", "person", "passenger", "adult", "child",
+    "vip", "meet", "greet", "porter", "transfer", "transit", "fast track", "refund",
+}
+_PRUNE_KEYWORD_RE = re.compile(r"\b(" + "|".join(re.escape(k) for k in sorted(_PRUNE_KEYWORDS)) + r")\b")
+_PRUNE_PRICE_RE   = re.compile(r"[€$£]\s?\d|\d[\d.,]*\s?(?:€|eur|usd|gbp|aed)\b")
+
+
+def _score_page(text: str) -> int:
+    text = text.lower()
+    hits = {}
+    for m in _PRUNE_KEYWORD_RE.finditer(text):
+        hits[m.group(1)] = min(hits.get(m.group(1), 0) + 1, 3)
+    prices = min(len(_PRUNE_PRICE_RE.findall(text)), 10)
+    return sum(hits.values()) + 2 * prices
 
+
+def _prune_pdf(pdf_bytes):
+    # Returns (bytes to send, report dict or None when nothing was pruned).
     try:
-        parsed = json.loads(attempt)
-        if isinstance(parsed, list):
-            print(f"🔧 [Repair] Bracket-close succeeded — {len(parsed)} service(s).")
-            return parsed
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        print("⚠️  [Prune] pypdf is not installed — sending the whole PDF.")
+        return pdf_bytes, None
+
+    started = time.perf_counter()
+    try:
+        reader = PdfReader(PdfBuffer(pdf_bytes))
+        total  = len(reader.pages)
+        if total < PRUNE_MIN_PAGES:
+            return pdf_bytes, None
+        scores = [_score_page(page.extract_text() or "") for page in reader.pages]
+    except Exception as e:
+        print(f"⚠️  [Prune] Could not analyse PDF ({e}) — sending it whole.")
+        return pdf_bytes, None
+
+    keep = sorted({
+        j
+        for i, score in enumerate(scores) if score >= PRUNE_MIN_SCORE
+        for j in range(i - PRUNE_CONTEXT_PAGES, i + PRUNE_CONTEXT_PAGES + 1)
+        if 0 <= j < total
+    })
+    if not keep or len(keep) == total:
+        # No text layer (scanned PDF) or every page matters — either way the
+        # whole document is the safe payload.
+        return pdf_bytes, None
+
+    writer = PdfWriter()
+    for i in keep:
+        writer.add_page(reader.pages[i])
+    out = io.BytesIO()
+    writer.write(out)
+    reduced = out.getvalue()
+
+    report = {
+        "pages_before":      total,
+        "pages_after":       len(keep),
+        "kept_pages":        [i + 1 for i in keep],
+        "page_scores":       scores,
+        "bytes_before":      len(pdf_bytes),
+        "bytes_after":       len(reduced),
+        "est_tokens_before": total * TOKENS_PER_PDF_PAGE,
+        "est_tokens_after":  len(keep) * TOKENS_PER_PDF_PAGE,
+        "analysis_seconds":  round(time.perf_counter() - started, 3),
+    }
+    print(f"✂️  [Prune] Kept {len(keep)}/{total} page(s) {report['kept_pages']} — "
+          f"~{report['est_tokens_before']} → ~{report['est_tokens_after']} input tokens "
+          f"(analysed in {report['analysis_seconds']}s).")
+    return reduced, report
+
+
+# ── RESPONSE PARSING ──────────────────────────────────────────────────────────
+# Outcomes are counted separately for schema-constrained and free-form
+# responses, so get_parse_stats() shows how often each needs repair or sends
+# the extraction on to another model.
+_parse_lock  = threading.Lock()
+_parse_stats = {
+    mode: {"responses": 0, "clean": 0, "repaired": 0, "failed": 0, "retried": 0,
+           "schema_violations": 0, "invalid_services": 0}
+    for mode in ("schema", "free")
+}
+
+
+def _parse_record(model, **increments):
+    mode = "schema" if _supports_schema(model) else "free"
+    with _parse_lock:
+        for k, v in increments.items():
+            _parse_stats[mode][k] += v
+
+
+def get_parse_stats() -> dict:
+    with _parse_lock:
+        stats = {mode: dict(counts) for mode, counts in _parse_stats.items()}
+    for counts in stats.values():
+        n = counts["responses"]
+        counts["repair_rate"] = round(counts["repaired"] / n, 3) if n else None
+        counts["retry_rate"]  = round(counts["retried"] / n, 3) if n else None
+    return stats
+
+
+def _parse_response(raw: str, model=None):
+    with metrics.stage("parse", model=model):
+        return _parse(raw, model)
+
+
+def _parse(raw: str, model):
+    print("🔍 [Parser] Parsing response...")
+    cleaned = raw.replace("```json", "").replace("```", "").strip()
+
+    try:
+        parsed = json.loads(cleaned)
         if isinstance(parsed, dict):
-            return [parsed]
-    except json.JSONDecodeError:
-        pass
+            parsed = [parsed]
+        print(f"🎉 [Parser] Clean parse — {len(parsed)} service(s).")
+        outcome = "clean"
+    except json.JSONDecodeError as e:
+        print(f"⚠️  [Parser] Clean parse failed: {e} — attempting repair...")
+        with metrics.stage("repair", model=model):
+            parsed = _repair_json(cleaned)
+        outcome = "repaired"
+        if parsed:
+            print(f"🎉 [Parser] Repaired — {len(parsed)} service(s).")
+
+    if not parsed or not isinstance(parsed, list):
+        _parse_record(model, responses=1, failed=1)
+        _router_record_parse(model, False)
+        return None, cleaned
+
+    # Schema violations are reported, not retried: a service with one odd
+    # field is still worth more than another full model attempt.
+    violations = validate_services(parsed)
+    if violations:
+        errors = [e for v in violations for e in v["errors"]]
+        print(f"📐 [Schema] {len(violations)}/{len(parsed)} service(s) off-schema — "
+              f"{'; '.join(errors[:3])}{' …' if len(errors) > 3 else ''}")
+    _parse_record(model, responses=1, **{outcome: 1},
+                  schema_violations=sum(len(v["errors"]) for v in violations),
+                  invalid_services=len(violations))
+    _router_record_parse(model, True)
+    return parsed, cleaned
+
+
+# Returns (filename, buffer to send, cache key, cached result or None). The cache
+# key is the SHA-256 of the original PDF, tagged when pages get pruned.
+def _read_pdf(pdf_file, use_cache: bool, prune: bool = False):
+    filename = _pdf_name(pdf_file)
+    print(f"\n📄 [Extract] Starting extraction for: {filename}")
 
-    print("🔧 [Repair] Attempting object-by-object salvage...")
-    objects, depth, start = [], 0, None
-    for i, ch in enumerate(raw):
-        if ch == "{":
-            if depth == 0:
-                start = i
-            depth += 1
-        elif ch == "}":
-            depth -= 1
-            if depth == 0 and start is not None:
-                try:
-                    objects.append(json.loads(raw[start:i + 1]))
-                except json.JSONDecodeError:
-                    pass
-                start = None
+    with metrics.stage("read"):
+        pdf_bytes = _pdf_view(pdf_file)
+        pdf_hash  = hashlib.sha256(pdf_bytes).hexdigest()
+    if prune:
+        pdf_hash += ":pruned"
 
-    if objects:
-        print(f"🔧 [Repair] Salvaged {len(objects)} object(s).")
-        return objects
+    cached = None
+    if use_cache:
+        cached = _cache_lookup(pdf_hash)
+    else:
+        with _cache_lock:
+            _cache_stats["bypassed"] += 1
+        print("⏭️  [Cache] Bypassed by caller.")
 
-    return None
+    if cached is None and prune:
+        with metrics.stage("prune"):
+            pdf_bytes, _report = _prune_pdf(pdf_bytes)
+
+    return filename, pdf_bytes, pdf_hash, cached
 
 
 # ── MAIN EXTRACTION ───────────────────────────────────────────────────────────
-def extract_fields_ai(pdf_file) -> list | dict:
-    filename = getattr(pdf_file, "name", "document.pdf")
-    print(f"\n📄 [Extract] Starting extraction for: {filename}")
+def _result_status(result) -> str:
+    return result.get("error", "ok") if isinstance(result, dict) else "ok"
+
+
+@metrics.timed("extract", status=_result_status)
+def extract_fields_ai(
+    pdf_file,
+    use_cache: bool = True,
+    hedge_delay: float | None = HEDGE_DELAY_SECONDS,
+    inline_max_bytes: int = INLINE_PDF_MAX_BYTES,
+    on_service=None,
+    prune_pages: bool = PRUNE_PAGES,
+) -> list | dict:
+    filename, pdf_bytes, pdf_hash, cached = _read_pdf(pdf_file, use_cache, prune_pages)
+    if cached is not None:
+        return cached
 
-    pdf_bytes = pdf_file.read()
     client    = get_client()
-    prompt    = _make_prompt()
+    prompt    = PROMPT
 
-    RETRYABLE = ("503", "429", "500", "UNAVAILABLE", "RESOURCE_EXHAUSTED", "INTERNAL", "TIMEOUT")
+    uploaded_file = None
+    if len(pdf_bytes) <= inline_max_bytes:
+        print(f"📎 [Inline] Sending {filename} inline ({len(pdf_bytes) / 1024:.1f} KB) — no Files API upload.")
+        pdf_part = _inline_part(pdf_bytes)
+    else:
+        try:
+            uploaded_file = _upload_pdf(client, pdf_bytes, filename)
+        except Exception as e:
+            print(f"💀 [Upload] Failed to upload PDF: {e}")
+            return {"error": "upload_failed", "detail": str(e)}
+        pdf_part = _file_part(uploaded_file)
 
-    try:
-        uploaded_file = _upload_pdf(client, pdf_bytes, filename)
-    except Exception as e:
-        print(f"💀 [Upload] Failed to upload PDF: {e}")
-        return {"error": "upload_failed", "detail": str(e)}
+    inflight = []
 
+    if hedge_delay is not None:
+        try:
+            model, services, error = _hedged_generate(
+                client, pdf_part, prompt, hedge_delay, inflight=inflight, on_service=on_service
+            )
+        finally:
+            _release_upload(client, uploaded_file, inflight)
+        if error:
+            if error["error"] == "model_call_failed":
+                return error
+            return _salvage_partial(error, (c["services"] for c in inflight))
+        if use_cache:
+            _cache_store(pdf_hash, model, services, filename)
+        return services
+
+    models = route_models()
     try:
-        for idx, model in enumerate(FALLBACK_MODELS):
-            position = f"{idx + 1}/{len(FALLBACK_MODELS)}"
+        for idx, model in enumerate(models):
+            position = f"{idx + 1}/{len(models)}"
             print(f"\n🚀 [Gemini] Trying model {position}: {model}  (timeout={MODEL_TIMEOUT_SECONDS}s)")
 
-            raw, err = _call_streaming_with_timeout(client, model, uploaded_file, prompt)
+            raw, err = _call_streaming_with_timeout(
+                client, model, pdf_part, prompt, inflight=inflight, on_service=on_service
+            )
+            for retry in range(RATE_LIMIT_RETRIES):
+                if not _is_quota_error(err):
+                    break
+                print(f"🚦 [Limiter] {model} over quota — queueing to retry it ({retry + 1}/{RATE_LIMIT_RETRIES}).")
+                raw, err = _call_streaming_with_timeout(
+                    client, model, pdf_part, prompt, inflight=inflight, on_service=on_service
+                )
 
             if err:
-                is_retryable = any(code in err for code in RETRYABLE)
-
-                if not is_retryable:
+                if not _is_retryable(err):
                     print(f"💀 [Gemini] Non-retryable error on {model}.")
                     print(f"   ↳ {err}")
                     return {"error": "model_call_failed", "detail": err}
 
-                if idx + 1 < len(FALLBACK_MODELS):
-                    delay = round(random.uniform(1, 3), 1)
+                if idx + 1 < len(models):
+                    metrics.inc("fallbacks_total", model=model, reason="error")
                     print(f"⚠️  [Gemini] {model} failed — moving to next model.")
                     print(f"   ↳ Reason    : {err[:120]}")
-                    print(f"   ↳ Next model: {FALLBACK_MODELS[idx + 1]}")
-                    print(f"   ↳ Waiting   : {delay}s...")
-                    time.sleep(delay)
+                    print(f"   ↳ Next model: {models[idx + 1]}")
                 else:
                     print(f"🛑 [Gemini] All models failed.")
-                    return {"error": "all_models_failed", "detail": err}
+                    return _salvage_partial(
+                        {"error": "all_models_failed", "detail": err},
+                        (c["services"] for c in inflight)
+                    )
 
                 continue
 
             print(f"✅ [Gemini] Got response from: {model}")
 
-            print("🔍 [Parser] Parsing response...")
-            cleaned = raw.replace("```json", "").replace("```", "").strip()
-
-            try:
-                parsed = json.loads(cleaned)
-                if isinstance(parsed, dict):
-                    parsed = [parsed]
-                print(f"🎉 [Parser] Clean parse — {len(parsed)} service(s).")
-                return parsed
-            except json.JSONDecodeError as e:
-                print(f"⚠️  [Parser] Clean parse failed: {e} — attempting repair...")
-
-            repaired = _repair_json(cleaned)
-            if repaired:
-                print(f"🎉 [Parser] Repaired — {len(repaired)} service(s).")
-                return repaired
+            services, cleaned = _parse_response(raw, model)
+            if services:
+                if use_cache:
+                    _cache_store(pdf_hash, model, services, filename)
+                return services
 
             print(f"💥 [Parser] Repair failed on {model}.")
             print(f"   ↳ Snippet: {cleaned[:200]}{'...' if len(cleaned) > 200 else ''}")
 
-            if idx + 1 < len(FALLBACK_MODELS):
-                print(f"   ↳ Trying next model: {FALLBACK_MODELS[idx + 1]}")
+            if idx + 1 < len(models):
+                print(f"   ↳ Trying next model: {models[idx + 1]}")
+                _parse_record(model, retried=1)
+                metrics.inc("fallbacks_total", model=model, reason="invalid_json")
                 continue
 
-            return {"error": "invalid_json", "raw": cleaned, "detail": "Repair failed on all models."}
+            return _salvage_partial(
+                {"error": "invalid_json", "raw": cleaned, "detail": "Repair failed on all models."},
+                (c["services"] for c in inflight)
+            )
 
     finally:
-        _delete_file(client, uploaded_file)
+        _release_upload(client, uploaded_file, inflight)
 
     return {"error": "all_models_failed", "detail": "Exhausted all models."}
 
 
+# ── ASYNC EXTRACTION ──────────────────────────────────────────────────────────
+# Same pipeline as extract_fields_ai, driven by the SDK's async client
+# (client.aio) so many extractions can share one event loop without a thread
+# per model call. Concurrency is capped by a per-event-loop semaphore.
+ASYNC_MAX_CONCURRENCY = 32
+
+_async_semaphores = weakref.WeakKeyDictionary()
+
+
+def _async_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _async_semaphores.get(loop)
+    if sem is None:
+        sem = _async_semaphores[loop] = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    return sem
+
+
+async def _upload_pdf_async(client, pdf_bytes, filename: str):
+    print(f"📤 [Upload] Uploading {filename} to Gemini Files API (async)...")
+    pdf_stream = PdfBuffer(pdf_bytes, filename)
+
+    with metrics.stage("upload"):
+        uploaded = await client.aio.files.upload(
+            file=pdf_stream,
+            config={"mime_type": "application/pdf", "display_name": filename}
+        )
+    print(f"✅ [Upload] File uploaded — URI: {uploaded.uri}")
+    return uploaded
+
+
+async def _delete_file_async(client, uploaded_file):
+    try:
+        with metrics.stage("delete"):
+            await client.aio.files.delete(name=uploaded_file.name)
+        print(f"🗑️  [Upload] Cleaned up remote file: {uploaded_file.name}")
+    except Exception as e:
+        print(f"⚠️  [Upload] Could not delete remote file: {e}")
+
+
+async def _aclose(stream):
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def _call_streaming_async(client, model, pdf_part, prompt, timeout=MODEL_TIMEOUT_SECONDS, partials=None, on_service=None):
+    parser = _ServiceStreamParser()
+    if partials is not None:
+        partials.append(parser.services)
+
+    chunks = []
+    state  = {"stream": None, "received": False, "first_at": None, "usage": None}
+
+    async def _consume(cached_content):
+        state["stream"] = await client.aio.models.generate_content_stream(
+            model=model,
+            contents=_build_contents(pdf_part, None if cached_content else prompt),
+            config=_generation_config(cached_content=cached_content, model=model)
+        )
+        async for chunk in state["stream"]:
+            state["received"] = True
+            if state["first_at"] is None:
+                state["first_at"] = time.monotonic()
+            state["usage"] = getattr(chunk, "usage_metadata", None) or state["usage"]
+            if chunk.text:
+                chunks.append(chunk.text)
+                for service in parser.feed(chunk.text):
+                    if on_service is not None:
+                        on_service(model, service)
+
+    async def _stream():
+        cached_content = None
+        if CONTEXT_CACHE and prompt == PROMPT:
+            hit, cached_content = _context_cache_lookup(model)
+            if not hit:
+                cached_content = await asyncio.to_thread(_context_cache_for, client, model)
+
+        try:
+            if cached_content:
+                try:
+                    await _consume(cached_content)
+                    return "".join(chunks).strip()
+                except Exception as e:
+                    if state["received"] or not _is_context_cache_error(e, cached_content):
+                        raise
+                    _invalidate_context_cache(model, cached_content, e)
+                    await _aclose(state["stream"])
+            await _consume(None)
+        finally:
+            # On timeout wait_for cancels this task; closing the stream here
+            # releases the underlying HTTP response instead of leaking it.
+            await _aclose(state["stream"])
+        return "".join(chunks).strip()
+
+    # Queue for the model's rate limiter without blocking the event loop.
+    limiter  = _limiter(model)
+    deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT_SECONDS
+    started  = time.monotonic()
+    while True:
+        acquired, wait = limiter.try_acquire()
+        if acquired:
+            limiter.record_wait(time.monotonic() - started)
+            break
+        if time.monotonic() >= deadline:
+            limiter.record_wait(time.monotonic() - started, timed_out=True)
+            return None, f"RESOURCE_EXHAUSTED: no {model} rate-limit slot within {RATE_LIMIT_MAX_WAIT_SECONDS}s"
+        await asyncio.sleep(min(wait if wait is not None else 0.05, 0.25))
+
+    err, cancelled = None, False
+    began = time.monotonic()
+    try:
+        return await asyncio.wait_for(_stream(), timeout=timeout), None
+    except asyncio.TimeoutError:
+        err = f"TIMEOUT after {timeout}s"
+        return None, err
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    except Exception as e:
+        err = str(e)
+        return None, err
+    finally:
+        outcome = _outcome(err, cancelled)
+        limiter.release(outcome)
+        first = state["first_at"]
+        _call_finished(model, outcome, time.monotonic() - began, first - began if first else None, state["usage"])
+
+
+@metrics.timed("extract", status=_result_status)
+async def extract_fields_ai_async(
+    pdf_file,
+    use_cache: bool = True,
+    semaphore=None,
+    inline_max_bytes: int = INLINE_PDF_MAX_BYTES,
+    on_service=None,
+    prune_pages: bool = PRUNE_PAGES,
+) -> list | dict:
+    filename, pdf_bytes, pdf_hash, cached = _read_pdf(pdf_file, use_cache, prune_pages)
+    if cached is not None:
+        return cached
+
+    async with semaphore or _async_semaphore():
+        client = get_async_client()
+        prompt = PROMPT
+
+        uploaded_file = None
+        if len(pdf_bytes) <= inline_max_bytes:
+            print(f"📎 [Inline] Sending {filename} inline ({len(pdf_bytes) / 1024:.1f} KB) — no Files API upload.")
+            pdf_part = _inline_part(pdf_bytes)
+        else:
+            try:
+                uploaded_file = await _upload_pdf_async(client, pdf_bytes, filename)
+            except Exception as e:
+                print(f"💀 [Upload] Failed to upload PDF: {e}")
+                return {"error": "upload_failed", "detail": str(e)}
+            pdf_part = _file_part(uploaded_file)
+
+        partials = []
+        models   = route_models()
+        try:
+            for idx, model in enumerate(models):
+                position = f"{idx + 1}/{len(models)}"
+                print(f"\n🚀 [Gemini] Trying model {position}: {model}  (async, timeout={MODEL_TIMEOUT_SECONDS}s)")
+
+                raw, err = await _call_streaming_async(
+                    client, model, pdf_part, prompt, partials=partials, on_service=on_service
+                )
+                for retry in range(RATE_LIMIT_RETRIES):
+                    if not _is_quota_error(err):
+                        break
+                    print(f"🚦 [Limiter] {model} over quota — queueing to retry it ({retry + 1}/{RATE_LIMIT_RETRIES}).")
+                    raw, err = await _call_streaming_async(
+                        client, model, pdf_part, prompt, partials=partials, on_service=on_service
+                    )
+
+                if err:
+                    if not _is_retryable(err):
+                        print(f"💀 [Gemini] Non-retryable error on {model}.")
+                        print(f"   ↳ {err}")
+                        return {"error": "model_call_failed", "detail": err}
+
+                    if idx + 1 < len(models):
+                        metrics.inc("fallbacks_total", model=model, reason="error")
+                        print(f"⚠️  [Gemini] {model} failed — moving to next model.")
+                        print(f"   ↳ Reason    : {err[:120]}")
+                    else:
+                        print("🛑 [Gemini] All models failed.")
+                        return _salvage_partial({"error": "all_models_failed", "detail": err}, partials)
+
+                    continue
+
+                print(f"✅ [Gemini] Got response from: {model}")
+
+                services, cleaned = _parse_response(raw, model)
+                if services:
+                    if use_cache:
+                        _cache_store(pdf_hash, model, services, filename)
+                    return services
+
+                print(f"💥 [Parser] Repair failed on {model}.")
+                if idx + 1 < len(models):
+                    _parse_record(model, retried=1)
+                    metrics.inc("fallbacks_total", model=model, reason="invalid_json")
+                    continue
+
+                return _salvage_partial(
+                    {"error": "invalid_json", "raw": cleaned, "detail": "Repair failed on all models."},
+                    partials
+                )
+
+        finally:
+            if uploaded_file is not None:
+                await _delete_file_async(client, uploaded_file)
+
+    return {"error": "all_models_failed", "detail": "Exhausted all models."}
+
+
+async def extract_many_async(pdf_files, max_concurrency: int = ASYNC_MAX_CONCURRENCY, use_cache: bool = True):
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _one(pdf_file):
+        try:
+            return pdf_file, await extract_fields_ai_async(pdf_file, use_cache, semaphore)
+        except Exception as e:
+            print(f"💀 [Batch] Extraction crashed for {getattr(pdf_file, 'name', pdf_file)}: {e}")
+            return pdf_file, {"error": "extraction_crashed", "detail": str(e)}
+
+    tasks = [asyncio.ensure_future(_one(f)) for f in pdf_files]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# ── BATCH EXTRACTION ──────────────────────────────────────────────────────────
+BATCH_MAX_WORKERS = 4
+
+
+# Runs extractions concurrently and yields events in arrival order:
+#   ("service", pdf_file, {"model": ..., "service": {...}})  as each service streams in
+#   ("done",    pdf_file, result)                            when a file finishes
+# Services from a model attempt that later fails can be superseded by the
+# next model's, so consumers should group "service" events by model.
+def stream_many(pdf_files, max_workers: int = BATCH_MAX_WORKERS, use_cache: bool = True):
+    files = list(pdf_files)
+    if not files:
+        return
+
+    workers = max(1, min(max_workers, len(files)))
+    print(f"\n📚 [Batch] Extracting {len(files)} file(s) with {workers} worker(s).")
+
+    events = queue.Queue()
+
+    def _run(pdf_file):
+        def _on_service(model, service):
+            events.put(("service", pdf_file, {"model": model, "service": service}))
+
+        try:
+            result = extract_fields_ai(pdf_file, use_cache, on_service=_on_service)
+        except Exception as e:
+            print(f"💀 [Batch] Extraction crashed for {getattr(pdf_file, 'name', pdf_file)}: {e}")
+            result = {"error": "extraction_crashed", "detail": str(e)}
+        events.put(("done", pdf_file, result))
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract")
+    try:
+        for f in files:
+            pool.submit(_run, f)
+
+        remaining = len(files)
+        while remaining:
+            event = events.get()
+            if event[0] == "done":
+                remaining -= 1
+            yield event
+    finally:
+        # If the caller stops iterating early, drop anything not yet started.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    print(f"🏁 [Batch] Finished {len(files)} file(s).")
+
+
+# Yields (pdf_file, result) pairs in completion order, not submission order.
+def extract_many(pdf_files, max_workers: int = BATCH_MAX_WORKERS, use_cache: bool = True):
+    for kind, pdf_file, payload in stream_many(pdf_files, max_workers, use_cache):
+        if kind == "done":
+            yield pdf_file, payload
+
+
+# ── PAGE-RANGE SHARDING ───────────────────────────────────────────────────────
+# Large multi-airport catalogues produce outputs long enough to time out or get
+# truncated. Sharding splits the PDF into page ranges, extracts every shard
+# concurrently with the normal prompt, and merges the service arrays. The same
+# service seen in several shards — keyed by (service_name, airport,
+# travel_type) — is kept once, with gaps filled from the other copies;
+# services with none of the three set are never merged. Each shard goes
+# through extract_fields_ai, so shards are cached individually. If some shards
+# fail, the merged services come back as a partial error naming them.
+SHARD_PAGES       = 8     # pages per shard
+SHARD_MIN_PAGES   = 16    # shorter documents are extracted whole
+SHARD_MAX_WORKERS = 4
+
+_DEDUPE_FIELDS = ("service_name", "airport", "travel_type")
+
+
+def _split_pdf(pdf_bytes, pages_per_shard: int):
+    # Returns [(first_page, last_page, shard_bytes), ...] or None if the PDF
+    # can't (or needn't) be split.
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        print("⚠️  [Shard] pypdf is not installed — extracting the whole PDF.")
+        return None
+
+    try:
+        reader = PdfReader(PdfBuffer(pdf_bytes))
+        total  = len(reader.pages)
+        if total < max(SHARD_MIN_PAGES, pages_per_shard + 1):
+            return None
+
+        shards = []
+        for first in range(0, total, pages_per_shard):
+            last   = min(first + pages_per_shard, total)
+            writer = PdfWriter()
+            for i in range(first, last):
+                writer.add_page(reader.pages[i])
+            out = io.BytesIO()
+            writer.write(out)
+            shards.append((first + 1, last, out.getvalue()))
+    except Exception as e:
+        print(f"⚠️  [Shard] Could not split PDF ({e}) — extracting it whole.")
+        return None
+
+    return shards
+
+
+def _is_blank(value) -> bool:
+    return value in (None, "", [], {})
+
+
+def _fill_gaps(base: dict, other: dict):
+    for k, v in other.items():
+        current = base.get(k)
+        if _is_blank(current):
+            base[k] = v
+        elif isinstance(current, dict) and isinstance(v, dict):
+            _fill_gaps(current, v)
+        elif isinstance(current, list) and isinstance(v, list):
+            current.extend(item for item in v if item not in current)
+
+
+def _merge_services(service_lists) -> list:
+    merged = {}
+    for services in service_lists:
+        for svc in services:
+            if not isinstance(svc, dict):
+                continue
+            key = tuple(str(svc.get(f) or "").strip().lower() for f in _DEDUPE_FIELDS)
+            if not any(key):
+                key = len(merged)        # nothing to identify it by — keep it as is
+            if key in merged:
+                _fill_gaps(merged[key], svc)
+            else:
+                merged[key] = svc
+    return list(merged.values())
+
+
+def extract_fields_sharded(
+    pdf_file,
+    pages_per_shard: int = SHARD_PAGES,
+    max_workers: int = SHARD_MAX_WORKERS,
+    use_cache: bool = True,
+) -> list | dict:
+    filename  = _pdf_name(pdf_file)
+    pdf_bytes = _pdf_view(pdf_file)
+
+    shards = _split_pdf(pdf_bytes, pages_per_shard)
+    if not shards:
+        return extract_fields_ai(PdfBuffer(pdf_bytes, filename), use_cache)
+
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    print(f"\n🧩 [Shard] Split {filename} into {len(shards)} shard(s) of up to {pages_per_shard} page(s).")
+
+    shard_files = []
+    for first, last, shard_bytes in shards:
+        shard_file = io.BytesIO(shard_bytes)
+        shard_file.name = f"{stem}.p{first}-{last}.pdf"
+        shard_files.append(shard_file)
+
+    results = {f.name: r for f, r in extract_many(shard_files, max_workers, use_cache)}
+    ordered = [results[f.name] for f in shard_files]
+
+    succeeded = [r for r in ordered if isinstance(r, list)]
+    failed    = {f.name: results[f.name] for f in shard_files if not isinstance(results[f.name], list)}
+    if not succeeded:
+        print(f"🛑 [Shard] Every shard of {filename} failed.")
+        return ordered[0]
+
+    merged = _merge_services(succeeded)
+    print(f"🧩 [Shard] Merged {sum(len(r) for r in succeeded)} service(s) into {len(merged)} unique.")
+    if failed:
+        print(f"⚠️  [Shard] {len(failed)} shard(s) failed and are missing from the result: {list(failed)}")
+        return {
+            "error": "shards_failed",
+            "detail": f"{len(failed)} of {len(shard_files)} shard(s) failed: {', '.join(failed)}",
+            "shards": failed,
+            "partial": merged,
+        }
+    return merged
+
+
 # ── MISSING FIELD CHECKER ─────────────────────────────────────────────────────
-def flag_missing_fields(service_list: list) -> list:
-    def _collect_missing(obj, prefix=""):
-        missing = []
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                path = f"{prefix}.{k}" if prefix else k
-                if isinstance(v, (dict, list)):
-                    missing.extend(_collect_missing(v, path))
-                elif v in (None, "", [], {}):
-                    missing.append(path)
-        elif isinstance(obj, list):
-            for i, item in enumerate(obj):
-                missing.extend(_collect_missing(item, f"{prefix}[{i}]"))
-        return missing
+# Services are checked against FIELD_PATHS rather than walked: a template field
+# that is absent, null or empty counts as missing, and keys outside the
+# template are ignored. An item that isn't an object at all (to_services passes
+# those through) is reported with every field missing.
+_BLANK = (None, "", [], {})
+
+
+def _leaf_values(svc) -> list:
+    # Values aligned with FIELD_PATHS, for a Service or a plain dict.
+    if isinstance(svc, Service):
+        return svc.leaf_values()
+    if not isinstance(svc, dict):
+        return [None] * len(FIELD_PATHS)
+    out = []
+    for key, children in _FIELD_TREE:
+        value = svc.get(key)
+        if children is None:
+            out.append(value)
+            continue
+        for sub, leaves in children:
+            node = value.get(sub) if isinstance(value, dict) else None
+            if isinstance(node, dict):
+                out += map(node.get, leaves)
+            else:
+                out += (None,) * len(leaves)
+    return out
+
+
+def _service_name(svc, idx: int):
+    default = f"Service {idx + 1}"
+    return svc.get("service_name", default) if isinstance(svc, (dict, Service)) else default
+
 
+def flag_missing_fields(service_list: list) -> list:
     return [
         {
             "service_index":  idx,
-            "service_name":   svc.get("service_name", f"Service {idx + 1}"),
-            "missing_fields": _collect_missing(svc)
+            "service_name":   _service_name(svc, idx),
+            "missing_fields": [path for path, value in zip(FIELD_PATHS, _leaf_values(svc)) if value in _BLANK]
         }
         for idx, svc in enumerate(service_list)
     ]
+
+
+# Completeness across a whole batch — a {file name: result} dict, or any
+# iterable of (file, result) pairs such as extract_many's output (file objects
+# are reported by their .name). The matrix is columnar: one row per service,
+# and for each field path a column of booleans (True = missing). Failed
+# extractions are listed under "errors".
+def missing_field_matrix(batch) -> dict:
+    items = batch.items() if isinstance(batch, dict) else batch
+
+    files, indexes, names, rows, errors = [], [], [], [], {}
+    for name, result in items:
+        name = getattr(name, "name", name)
+        if isinstance(result, dict):
+            if result.get("error"):
+                errors[name] = result["error"]
+                continue
+            result = [result]
+        for idx, svc in enumerate(result):
+            files.append(name)
+            indexes.append(idx)
+            names.append(_service_name(svc, idx))
+            rows.append([value in _BLANK for value in _leaf_values(svc)])
+
+    columns = list(zip(*rows)) if rows else [() for _ in FIELD_PATHS]
+    total   = len(rows)
+    return {
+        "fields":        list(FIELD_PATHS),
+        "file":          files,
+        "service_index": indexes,
+        "service_name":  names,
+        "missing":       {path: list(col) for path, col in zip(FIELD_PATHS, columns)},
+        "missing_count": [sum(row) for row in rows],
+        "missing_rate":  {path: (round(sum(col) / total, 4) if total else None) for path, col in zip(FIELD_PATHS, columns)},
+        "errors":        errors,
+    }
+
+
+# ── METRICS ───────────────────────────────────────────────────────────────────
+# The stats above are exported next to the stage timers by metrics_v2.
+metrics.register_collector("client", get_client_stats)
+metrics.register_collector("result_cache", get_cache_stats)
+metrics.register_collector("context_cache", get_context_cache_stats)
+metrics.register_collector("pool", get_model_pool_stats)
+metrics.register_collector("rate_limiter", get_rate_limiter_stats, label="model")
+metrics.register_collector("hedge", get_hedge_stats, label="model")
+metrics.register_collector("parse", get_parse_stats, label="mode")
+metrics.register_collector(
+    "router",
+    lambda: {model: dict(stats, circuit_open=stats["state"] == "open")
+             for model, stats in get_router_stats()["models"].items()},
+    label="model",
+)
@@ -0,0 +1,516 @@
+# bench_v2.py — Benchmarks for the PDF Extractor backend
+# ─────────────────────────────────────────────────────────────────────────────
+# Usage:
+#   python bench_v2.py transport rate_card.pdf brochure.pdf --runs 5
+#   python bench_v2.py repair --services 500 --runs 20
+#   python bench_v2.py prune brochure.pdf --runs 3
+#   python bench_v2.py offline --docs 200 --workers 8 --errors 429=0.02,503=0.02 --out new.json --compare old.json
+#
+# Every benchmark prints a short table and, with --out, writes its raw numbers
+# as JSON (with the git commit) so runs can be compared.
+
+import io
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import platform
+import contextlib
+import statistics
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import app_v2
+import fake_gemini
+from review_v2 import VerificationIndex
+
+
+# ── HELPERS ───────────────────────────────────────────────────────────────────
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _summarise(samples):
+    return {
+        "runs":   len(samples),
+        "mean_s": round(statistics.mean(samples), 4) if samples else None,
+        "p50_s":  round(_percentile(samples, 50), 4) if samples else None,
+        "p95_s":  round(_percentile(samples, 95), 4) if samples else None,
+        "p99_s":  round(_percentile(samples, 99), 4) if samples else None,
+        "min_s":  round(min(samples), 4) if samples else None,
+        "max_s":  round(max(samples), 4) if samples else None,
+    }
+
+
+def _git_commit():
+    try:
+        head  = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        return head + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _write_json(path, payload):
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(payload, fh, indent=2)
+    print(f"💾 [Bench] Wrote results to {path}")
+
+
+# ── TRANSPORT: INLINE BYTES vs FILES API ──────────────────────────────────────
+# End-to-end extract_fields_ai latency for the same PDF sent inline and via
+# upload → generate → delete. Modes are interleaved per run so drift in model
+# latency hits both paths equally. Uses the real API (and quota).
+def bench_transport(paths, runs=3):
+    results = {}
+    for path in paths:
+        with open(path, "rb") as fh:
+            pdf_bytes = fh.read()
+
+        modes   = {"inline": len(pdf_bytes), "upload": -1}
+        samples = {mode: [] for mode in modes}
+        errors  = {mode: 0 for mode in modes}
+
+        for _ in range(runs):
+            for mode, inline_max in modes.items():
+                pdf_file = io.BytesIO(pdf_bytes)
+                pdf_file.name = os.path.basename(path)
+
+                start  = time.perf_counter()
+                result = app_v2.extract_fields_ai(pdf_file, use_cache=False, inline_max_bytes=inline_max)
+                samples[mode].append(time.perf_counter() - start)
+
+                if isinstance(result, dict) and result.get("error"):
+                    errors[mode] += 1
+
+        results[path] = {"bytes": len(pdf_bytes)}
+        for mode in modes:
+            results[path][mode] = {**_summarise(samples[mode]), "errors": errors[mode]}
+
+    print(f"\n{'file':<40} {'KB':>8} {'inline p50':>11} {'upload p50':>11} {'saved':>8}")
+    for path, row in results.items():
+        inline, upload = row["inline"]["p50_s"], row["upload"]["p50_s"]
+        print(f"{os.path.basename(path)[:40]:<40} {row['bytes'] / 1024:>8.1f} "
+              f"{inline:>10.2f}s {upload:>10.2f}s {upload - inline:>7.2f}s")
+    return results
+
+
+# ── JSON REPAIR: SINGLE PASS vs THREE-STAGE ──────────────────────────────────
+# The three-stage repair _repair_json used before the single-pass scanner, kept
+# here (without json_repair or logging) as the baseline.
+def _legacy_repair_json(raw: str):
+    attempt = raw.rstrip()
+    if attempt.endswith(","):
+        attempt = attempt[:-1]
+    attempt += "}" * max(attempt.count("{") - attempt.count("}"), 0)
+    attempt += "]" * max(attempt.count("[") - attempt.count("]"), 0)
+
+    try:
+        parsed = json.loads(attempt)
+        if isinstance(parsed, list):
+            return parsed
+        if isinstance(parsed, dict):
+            return [parsed]
+    except json.JSONDecodeError:
+        pass
+
+    objects, depth, start = [], 0, None
+    for i, ch in enumerate(raw):
+        if ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0 and start is not None:
+                try:
+                    objects.append(json.loads(raw[start:i + 1]))
+                except json.JSONDecodeError:
+                    pass
+                start = None
+
+    return objects or None
+
+
+def _synthetic_output(n_services: int) -> str:
+    # A model-sized response: full template per service, quoted text with
+    # braces and escaped quotes in it, pretty-printed like the model does.
+    services = []
+    for i in range(n_services):
+        svc = copy.deepcopy(app_v2.SERVICE_TEMPLATE)
+        svc.update({
+            "service_name": f"VIP Meet & Greet {i}",
+            "airport": "LHR",
+            "travel_type": "arrival" if i % 2 else "departure",
+            "cancellation_policy": 'Free until 48h {before}; then 50% — "late" [tier 2] fee \\ applies',
+            "usp": "Private lounge {\"quiet\" zone} with [fast] track",
+            "service_details": ["Porter {1 bag}", "Buggy \"on request\""],
+        })
+        svc["pricing"]["1_pax"]["adults"] = 475 + i
+        services.append(svc)
+    return json.dumps(services, indent=2)
+
+
+def _repair_cases(n_services: int) -> dict:
+    full = _synthetic_output(n_services)
+    return {
+        "trailing_text":     full + "\n\nLet me know if you need anything else {ok}.",
+        "truncated_string":  full[: int(len(full) * 0.8)].rsplit('"', 1)[0] + '"Free until 48',
+        "truncated_object":  full[: int(len(full) * 0.6)],
+        "truncated_comma":   full[: full.rfind("},") + 2],
+        "bracketed_prose":   "Here is [the] result:\n" + full[: full.rfind("},") + 1],
+    }
+
+
+def bench_repair(n_services=200, runs=10):
+    cases   = _repair_cases(n_services)
+    engines = {"single_pass": lambda raw: app_v2._salvage_json(raw)[0], "three_stage": _legacy_repair_json}
+    results = {}
+
+    for case, raw in cases.items():
+        results[case] = {"chars": len(raw)}
+        for name, fn in engines.items():
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                recovered = fn(raw)
+                samples.append(time.perf_counter() - start)
+            results[case][name] = {**_summarise(samples), "services": len(recovered or [])}
+
+    print(f"\n{'case':<18} {'chars':>9} {'single-pass':>18} {'three-stage':>18}")
+    for case, row in results.items():
+        cells = [f"{row[e]['p50_s'] * 1000:>8.2f}ms {row[e]['services']:>5}svc" for e in engines]
+        print(f"{case:<18} {row['chars']:>9} {cells[0]:>18} {cells[1]:>18}")
+    return results
+
+
+# ── PAGE PRUNING: WHOLE PDF vs RELEVANT PAGES ────────────────────────────────
+# Reports the page/token reduction from the local pre-pass and, unless
+# --analyse-only, end-to-end extract_fields_ai latency with and without it.
+def bench_prune(paths, runs=3, analyse_only=False):
+    results = {}
+    for path in paths:
+        with open(path, "rb") as fh:
+            pdf_bytes = fh.read()
+
+        _reduced, report = app_v2._prune_pdf(pdf_bytes)
+        results[path] = {"report": report}
+        if analyse_only:
+            continue
+
+        samples = {"whole": [], "pruned": []}
+        counts  = {"whole": [], "pruned": []}
+        for _ in range(runs):
+            for mode in samples:
+                pdf_file = io.BytesIO(pdf_bytes)
+                pdf_file.name = os.path.basename(path)
+
+                start  = time.perf_counter()
+                result = app_v2.extract_fields_ai(pdf_file, use_cache=False, prune_pages=(mode == "pruned"))
+                samples[mode].append(time.perf_counter() - start)
+                counts[mode].append(len(result) if isinstance(result, list) else 0)
+
+        for mode in samples:
+            results[path][mode] = {**_summarise(samples[mode]), "services": counts[mode]}
+
+    print(f"\n{'file':<32} {'pages':>9} {'~tokens':>13} {'whole p50':>10} {'pruned p50':>11}")
+    for path, row in results.items():
+        rep = row["report"]
+        pages  = f"{rep['pages_before']}→{rep['pages_after']}" if rep else "unpruned"
+        tokens = f"{rep['est_tokens_before']}→{rep['est_tokens_after']}" if rep else "-"
+        whole  = f"{row['whole']['p50_s']:.2f}s" if "whole" in row else "-"
+        pruned = f"{row['pruned']['p50_s']:.2f}s" if "pruned" in row else "-"
+        print(f"{os.path.basename(path)[:32]:<32} {pages:>9} {tokens:>13} {whole:>10} {pruned:>11}")
+    return results
+
+
+# ── OFFLINE SUITE: FAKE BACKEND ───────────────────────────────────────────────
+# Pipeline throughput without the API or quota: extract_fields_ai against
+# fake_gemini (synthetic or recorded responses, with injected latency,
+# truncation and 429/503/timeout errors), plus the CPU-bound steps —
+# _repair_json, flag_missing_fields and the review screen's rebuild — at
+# scale — and the cold import time of app_v2, which every worker process and
+# CLI run pays. Timings are taken with tracemalloc off; peak memory comes from
+# a second, traced pass. Rate limits and the call pool are lifted unless
+# --real-limits, so the numbers measure the code rather than the quota policy.
+OFFLINE_BENCHES = ("import", "extract", "repair", "missing", "rebuild")
+
+# Modules app_v2 must not load at import time.
+_HEAVY_IMPORTS = ("streamlit", "google.genai")
+
+_IMPORT_PROBE = """
+import sys, json, time, tracemalloc
+if sys.argv[1] == "trace":
+    tracemalloc.start()
+start = time.perf_counter()
+import app_v2
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "peak_kb": tracemalloc.get_traced_memory()[1] / 1024,
+                  "loaded": [m for m in %r if m in sys.modules]}))
+""" % (_HEAVY_IMPORTS,)
+
+
+@contextlib.contextmanager
+def _quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _peak_kb(fn) -> float:
+    tracemalloc.start()
+    try:
+        with _quiet():
+            fn()
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def _timed_runs(fn, runs):
+    samples = []
+    with _quiet():
+        for _ in range(runs):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _offline_row(samples, ops, wall, peak_kb, **extra):
+    return {**_summarise(samples), "ops": ops, "ops_per_s": round(ops / wall, 2) if wall else None,
+            "peak_kb": peak_kb, **extra}
+
+
+def _parse_errors(spec) -> dict:
+    # "429=0.02,503=0.01,timeout=0.005" -> {"429": 0.02, ...}
+    errors = {}
+    for item in filter(None, (spec or "").split(",")):
+        kind, _, rate = item.partition("=")
+        errors[kind.strip()] = float(rate)
+    return errors
+
+
+def _lift_limits(workers):
+    app_v2.RATE_LIMIT_RPS     = app_v2.RATE_LIMIT_BURST = 1e9
+    app_v2.AIMD_INITIAL_LIMIT = app_v2.AIMD_MAX_LIMIT = 10 ** 6
+    with _quiet():
+        app_v2.configure_model_pool(max(app_v2.MAX_LIVE_MODEL_CALLS, workers))
+
+
+def _import_probe(mode):
+    out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE, mode], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def bench_offline_import(runs=20):
+    # Each run is a fresh interpreter, so nothing is warm but the OS cache.
+    probes  = [_import_probe("time") for _ in range(runs)]
+    traced  = _import_probe("trace")
+    loaded  = sorted({m for probe in probes for m in probe["loaded"]})
+    samples = [probe["seconds"] for probe in probes]
+    if loaded:
+        print(f"⚠️  [Bench] Importing app_v2 loaded {', '.join(loaded)}.")
+    return _offline_row(samples, runs, sum(samples), round(traced["peak_kb"], 1), eager_imports=loaded)
+
+
+def bench_offline_extract(docs=100, workers=8, services=5, recordings=None, latency=0.0, first_chunk=0.0,
+                          chunk_size=256, errors=None, truncate_rate=0.0, hang=2.0, seed=0, real_limits=False):
+    responses = fake_gemini.load_recordings(recordings) if recordings else [_synthetic_output(services)]
+    if not real_limits:
+        _lift_limits(workers)
+
+    def _run():
+        # A fresh fake, router and limiter state per pass keeps the two
+        # passes identical for a given seed.
+        fake = fake_gemini.FakeClient(
+            response=responses, chunk_size=chunk_size, latency=latency, first_chunk_latency=first_chunk,
+            truncate_rate=truncate_rate, errors=errors, hang_seconds=hang, seed=seed,
+        )
+        app_v2.get_client = lambda: fake
+        app_v2.reset_router()
+        app_v2.reset_rate_limiters()
+
+        def _one(i):
+            pdf_file = io.BytesIO(b"%%PDF-1.4 bench document %d" % i)
+            pdf_file.name = f"bench_{i}.pdf"
+            start  = time.perf_counter()
+            result = app_v2.extract_fields_ai(pdf_file, use_cache=False)
+            return time.perf_counter() - start, result
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            outcomes = list(pool.map(_one, range(docs)))
+        return time.perf_counter() - started, outcomes, fake
+
+    with _quiet():
+        wall, outcomes, fake = _run()
+    peak = _peak_kb(_run)
+
+    status = {}
+    for _seconds, result in outcomes:
+        key = result.get("error", "error") if isinstance(result, dict) else "ok"
+        status[key] = status.get(key, 0) + 1
+    faults = {}
+    for request in fake.requests:
+        if request.get("fault"):
+            faults[request["fault"]] = faults.get(request["fault"], 0) + 1
+    return _offline_row([seconds for seconds, _ in outcomes], docs, wall, peak,
+                        model_calls=len(fake.requests), status=status, faults=faults)
+
+
+def bench_offline_repair(services=200, runs=20):
+    cases  = list(_repair_cases(services).values())
+    run    = lambda: [app_v2._repair_json(raw) for raw in cases]
+    samples = _timed_runs(run, runs)
+    return _offline_row(samples, runs * len(cases), sum(samples), _peak_kb(run), cases=len(cases))
+
+
+def bench_offline_missing(services=1000, runs=20):
+    service_list = json.loads(_synthetic_output(services))
+    run     = lambda: app_v2.flag_missing_fields(service_list)
+    samples = _timed_runs(run, runs)
+    return _offline_row(samples, runs * services, sum(samples), _peak_kb(run))
+
+
+def bench_offline_rebuild(services=1000, runs=20, edit_every=10):
+    # The review screen's download path: every service rebuilt from the
+    # Service model with one in edit_every value widgets edited.
+    models = app_v2.to_services(json.loads(_synthetic_output(services)))
+    review = VerificationIndex()
+    review.register("bench.pdf", [svc.to_dict() for svc in models])
+    for n, value_key in enumerate(list(review._locations)):
+        if n % edit_every == 0:
+            review.set_edit(value_key, "edited")
+
+    run     = lambda: review.rebuild("bench.pdf", [svc.to_dict() for svc in models])
+    samples = _timed_runs(run, runs)
+    return _offline_row(samples, runs * services, sum(samples), _peak_kb(run))
+
+
+def _compare(results, baseline_path):
+    with open(baseline_path, "r", encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    old = baseline.get("results", {})
+    print(f"\nvs {baseline.get('commit') or baseline_path}")
+    print(f"{'bench':<10} {'ops/s':>22} {'p50 ms':>20} {'p99 ms':>20} {'peak KB':>22}")
+
+    def _cell(before, after, scale=1.0):
+        if before is None or after is None:
+            return "-"
+        change = f"{(after - before) / before:+.0%}" if before else ""
+        return f"{before * scale:.1f}→{after * scale:.1f} {change}"
+
+    for name, row in results.items():
+        prev = old.get(name)
+        if prev is None:
+            continue
+        print(f"{name:<10} {_cell(prev.get('ops_per_s'), row['ops_per_s']):>22} "
+              f"{_cell(prev.get('p50_s'), row['p50_s'], 1000):>20} {_cell(prev.get('p99_s'), row['p99_s'], 1000):>20} "
+              f"{_cell(prev.get('peak_kb'), row['peak_kb']):>22}")
+
+
+def bench_offline(only=OFFLINE_BENCHES, **params):
+    extract_keys = ("docs", "workers", "services", "recordings", "latency", "first_chunk", "chunk_size",
+                    "errors", "truncate_rate", "hang", "seed", "real_limits")
+    runs, scale = params["runs"], params["scale"]
+    benches = {
+        "import":  lambda: bench_offline_import(runs=runs),
+        "extract": lambda: bench_offline_extract(**{k: params[k] for k in extract_keys}),
+        "repair":  lambda: bench_offline_repair(services=max(1, scale // 5), runs=runs),
+        "missing": lambda: bench_offline_missing(services=scale, runs=runs),
+        "rebuild": lambda: bench_offline_rebuild(services=scale, runs=runs),
+    }
+    results = {name: benches[name]() for name in OFFLINE_BENCHES if name in only}
+
+    print(f"\n{'bench':<10} {'ops':>8} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KB':>10}")
+    for name, row in results.items():
+        print(f"{name:<10} {row['ops']:>8} {row['ops_per_s']:>10} {row['p50_s'] * 1000:>9.2f} "
+              f"{row['p95_s'] * 1000:>9.2f} {row['p99_s'] * 1000:>9.2f} {row['peak_kb']:>10}")
+    if "extract" in results:
+        row = results["extract"]
+        print(f"extract: {row['model_calls']} model call(s), status {row['status']}, injected {row['faults']}")
+    return results
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF Extractor benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p_transport = sub.add_parser("transport", help="inline bytes vs Files API upload, end to end")
+    p_transport.add_argument("pdfs", nargs="+")
+    p_transport.add_argument("--runs", type=int, default=3)
+    p_transport.add_argument("--out")
+
+    p_repair = sub.add_parser("repair", help="single-pass JSON salvage vs the old three-stage repair")
+    p_repair.add_argument("--services", type=int, default=200)
+    p_repair.add_argument("--runs", type=int, default=10)
+    p_repair.add_argument("--out")
+
+    p_prune = sub.add_parser("prune", help="page pruning: token reduction and end-to-end latency")
+    p_prune.add_argument("pdfs", nargs="+")
+    p_prune.add_argument("--runs", type=int, default=3)
+    p_prune.add_argument("--analyse-only", action="store_true", help="skip the model calls")
+    p_prune.add_argument("--out")
+
+    p_offline = sub.add_parser("offline", help="pipeline throughput against the fake backend (no API calls)")
+    p_offline.add_argument("--only", default=",".join(OFFLINE_BENCHES), help="comma-separated subset of "
+                           + ", ".join(OFFLINE_BENCHES))
+    p_offline.add_argument("--docs", type=int, default=100, help="documents for the extract bench")
+    p_offline.add_argument("--workers", type=int, default=8)
+    p_offline.add_argument("--services", type=int, default=5, help="services per synthetic response")
+    p_offline.add_argument("--recordings", help="directory or .jsonl of recorded responses to serve instead")
+    p_offline.add_argument("--latency", type=float, default=0.0, help="seconds per streamed chunk")
+    p_offline.add_argument("--first-chunk", type=float, default=0.0, help="seconds before the first chunk")
+    p_offline.add_argument("--chunk-size", type=int, default=256)
+    p_offline.add_argument("--errors", default="", help="fault rates, e.g. 429=0.02,503=0.02,timeout=0.01")
+    p_offline.add_argument("--truncate", type=float, default=0.0, help="share of responses cut off mid-stream")
+    p_offline.add_argument("--hang", type=float, default=2.0, help="seconds an injected timeout hangs")
+    p_offline.add_argument("--seed", type=int, default=0)
+    p_offline.add_argument("--real-limits", action="store_true", help="keep the rate limiter and pool limits")
+    p_offline.add_argument("--scale", type=int, default=1000, help="services for the missing/rebuild benches")
+    p_offline.add_argument("--runs", type=int, default=20)
+    p_offline.add_argument("--out")
+    p_offline.add_argument("--compare", help="earlier --out file to diff against")
+
+    args = parser.parse_args(argv)
+
+    if args.bench == "transport":
+        results = bench_transport(args.pdfs, runs=args.runs)
+    elif args.bench == "repair":
+        results = bench_repair(n_services=args.services, runs=args.runs)
+    elif args.bench == "prune":
+        results = bench_prune(args.pdfs, runs=args.runs, analyse_only=args.analyse_only)
+    elif args.bench == "offline":
+        params  = {
+            "docs": args.docs, "workers": args.workers, "services": args.services, "recordings": args.recordings,
+            "latency": args.latency, "first_chunk": args.first_chunk, "chunk_size": args.chunk_size,
+            "errors": _parse_errors(args.errors), "truncate_rate": args.truncate, "hang": args.hang,
+            "seed": args.seed, "real_limits": args.real_limits, "scale": args.scale, "runs": args.runs,
+        }
+        results = bench_offline(only=args.only.split(","), **params)
+        if args.compare:
+            _compare(results, args.compare)
+
+    if args.out:
+        payload = {"bench": args.bench, "commit": _git_commit(), "python": platform.python_version(),
+                   "results": results}
+        if args.bench == "offline":
+            payload["params"] = params
+        _write_json(args.out, payload)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
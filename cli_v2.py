@@ -0,0 +1,211 @@
+# cli_v2.py — Headless batch runner for the PDF Extractor
+# ─────────────────────────────────────────────────────────────────────────────
+# Usage:
+#   python cli_v2.py rate_cards/ --out results.jsonl
+#   python cli_v2.py "archive/**/*.pdf" --out backfill.jsonl --workers 8 --processes 4
+#
+# Every PDF becomes one JSON line in --out, appended as soon as it finishes:
+#   {"file", "sha256", "ok", "services" | "error" [+ "partial"], "seconds"}
+# A PDF whose content repeats an earlier one in the same run is not extracted
+# again; its line is {"file", "sha256", "ok", "duplicate_of", "seconds"},
+# pointing at the file that was, and is written together with that file's.
+# The SHA-256 of every successfully extracted PDF is appended to <out>.done.
+# Re-running the same command skips those, so an interrupted backfill resumes
+# where it stopped. Failed PDFs are not checkpointed and are retried next run.
+# --metrics-out appends a metrics_v2 snapshot (stage timings, token usage…) at
+# the end; --metrics-port serves them live while the run is going. Both cover
+# this process only, so with --processes > 1 they see no model calls. Those
+# processes share one rate-limit budget through <out>.limits.sqlite3 (or
+# $EXTRACT_RATE_LIMIT_DB).
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import app_v2
+import metrics_v2 as metrics
+
+
+# ── INPUT ─────────────────────────────────────────────────────────────────────
+def collect_pdfs(patterns) -> list:
+    # Directories are searched recursively; anything else is a glob.
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.pdf")
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isfile(path) and path.lower().endswith(".pdf"):
+                paths.add(os.path.abspath(path))
+    return sorted(paths)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_done(path: str) -> set:
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            return {line.strip() for line in fh if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+# ── EXTRACTION ────────────────────────────────────────────────────────────────
+def _extract_one(path: str, sha256: str, use_cache: bool) -> dict:
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as fh:
+            result = app_v2.extract_fields_ai(fh, use_cache=use_cache)
+    except Exception as e:
+        result = {"error": "exception", "detail": f"{type(e).__name__}: {e}"}
+
+    record = {"file": path, "sha256": sha256}
+    if isinstance(result, dict) and result.get("error"):
+        # Services salvaged from a cut-off stream are written out for
+        # inspection, but the file still counts as failed and is retried.
+        error = dict(result)
+        partial = error.pop("partial", None)
+        record.update(ok=False, error=error)
+        if partial:
+            record["partial"] = partial
+    else:
+        record.update(ok=True, services=result if isinstance(result, list) else [result])
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def _extract_chunk(items, workers: int, use_cache: bool) -> list:
+    # Runs in a worker process: one chunk of files, `workers` at a time.
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="cli") as pool:
+        return list(pool.map(lambda item: _extract_one(*item, use_cache), items))
+
+
+# ── RUNNER ────────────────────────────────────────────────────────────────────
+def run(patterns, out: str, workers: int = 4, processes: int = 1, use_cache: bool = True) -> dict:
+    started = time.perf_counter()
+    paths   = collect_pdfs(patterns)
+    done    = _load_done(out + ".done")
+
+    todo, skipped, duplicates = [], 0, {}     # duplicates: sha256 -> later paths
+    for path in paths:
+        sha256 = _sha256(path)
+        if sha256 in done:
+            skipped += 1
+        elif sha256 in duplicates:
+            duplicates[sha256].append(path)
+        else:
+            duplicates[sha256] = []
+            todo.append((path, sha256))
+    n_dupes = sum(map(len, duplicates.values()))
+
+    print(f"🗂️  [CLI] {len(paths)} PDF(s) found — {skipped} already done, {n_dupes} duplicate, {len(todo)} to extract "
+          f"({processes} process(es) × {workers} worker(s)).", file=sys.stderr)
+
+    counts = {"found": len(paths), "skipped": skipped, "duplicates": n_dupes, "ok": 0, "failed": 0}
+    if not todo:
+        return counts
+
+    # The result lines are written before the checkpoint, so a crash between
+    # the two can only duplicate lines on resume — never lose one.
+    with open(out, "a", encoding="utf-8") as out_fh, open(out + ".done", "a", encoding="utf-8") as done_fh:
+
+        def _write(record):
+            out_fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+            for path in duplicates.get(record["sha256"], ()):
+                out_fh.write(json.dumps({"file": path, "sha256": record["sha256"], "ok": record["ok"],
+                                         "duplicate_of": record["file"], "seconds": 0.0}, ensure_ascii=False) + "\n")
+            out_fh.flush()
+            if record["ok"]:
+                done_fh.write(record["sha256"] + "\n")
+                done_fh.flush()
+                counts["ok"] += 1
+            else:
+                counts["failed"] += 1
+            finished = counts["ok"] + counts["failed"]
+            if record["ok"]:
+                status = f"{len(record['services'])} service(s)"
+            else:
+                status = record["error"].get("error")
+                if record.get("partial"):
+                    status += f" ({len(record['partial'])} partial service(s))"
+            print(f"{'✅' if record['ok'] else '❌'} [CLI] {finished}/{len(todo)} {os.path.basename(record['file'])} — "
+                  f"{status} in {record['seconds']}s", file=sys.stderr)
+
+        if processes <= 1:
+            executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="cli")
+            pending  = {executor.submit(_extract_one, path, sha256, use_cache): [(path, sha256)]
+                        for path, sha256 in todo}
+        else:
+            # Each task is a chunk of `workers` files so every process keeps
+            # that many model calls in flight. The processes share one
+            # rate-limit budget through a SQLite file next to the output.
+            chunks   = [todo[i:i + workers] for i in range(0, len(todo), max(1, workers))]
+            executor = ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=app_v2.share_rate_limits,
+                initargs=(app_v2.RATE_LIMIT_DB or out + ".limits.sqlite3",)
+            )
+            pending  = {executor.submit(_extract_chunk, chunk, workers, use_cache): chunk for chunk in chunks}
+
+        try:
+            for future in futures.as_completed(pending):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # A worker process died; its files stay unchecked and are
+                    # picked up again on the next run.
+                    result = [
+                        {"file": path, "sha256": sha256, "ok": False, "seconds": None,
+                         "error": {"error": "worker_failed", "detail": f"{type(e).__name__}: {e}"}}
+                        for path, sha256 in pending[future]
+                    ]
+                for record in result if isinstance(result, list) else [result]:
+                    _write(record)
+        except KeyboardInterrupt:
+            print("🛑 [CLI] Interrupted — finished results are saved; re-run to resume.", file=sys.stderr)
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    elapsed = time.perf_counter() - started
+    counts["seconds"] = round(elapsed, 1)
+    print(f"🏁 [CLI] {counts['ok']} ok, {counts['failed']} failed, {skipped} skipped, {n_dupes} duplicate in {elapsed:.1f}s "
+          f"({(counts['ok'] + counts['failed']) / elapsed:.2f} docs/s).", file=sys.stderr)
+    return counts
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract airport VIP services from PDFs in bulk")
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories (searched recursively) or globs")
+    parser.add_argument("--out", default="results.jsonl", help="JSONL output; <out>.done holds the checkpoint")
+    parser.add_argument("--workers", type=int, default=app_v2.BATCH_MAX_WORKERS,
+                        help="concurrent extractions per process")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes (1 = run in this process)")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the on-disk result cache")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve /metrics on this port during the run")
+    parser.add_argument("--metrics-out", default=None, help="append a JSON metrics snapshot to this file when done")
+    args = parser.parse_args(argv)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    counts = run(args.inputs, args.out, workers=args.workers, processes=args.processes,
+                 use_cache=not args.no_cache)
+    if args.metrics_out:
+        metrics.write_jsonl(args.metrics_out)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
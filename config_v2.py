@@ -0,0 +1,121 @@
+# config_v2.py — Backend configuration: API key and model chain
+# ─────────────────────────────────────────────────────────────────────────────
+# Settings are looked up lazily, on first use, through a chain of providers:
+#
+#   EnvConfig       environment variables        GOOGLE_API=…  EXTRACT_MODELS=a,b,c
+#   FileConfig      a JSON or TOML file          $EXTRACT_CONFIG, else .streamlit/secrets.toml
+#   SecretsConfig   streamlit's st.secrets       (only imports streamlit if reached)
+#
+# The first provider with a value wins and is cached; a setting nobody provides
+# is looked up again next time, so one set later is still picked up. Worker
+# processes and the CLI read the key from the environment or the secrets file
+# without importing Streamlit; the app itself still finds it where it always
+# did. Swap the chain with use(), e.g. config_v2.use(config_v2.FileConfig("prod.toml")).
+
+import os
+import json
+import threading
+
+KEYS = {
+    "api_key": ("GOOGLE_API",),
+    "models":  ("EXTRACT_MODELS",),
+}
+
+DEFAULT_FILES = (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit", "secrets.toml"),
+    os.path.join(".streamlit", "secrets.toml"),
+)
+
+
+class EnvConfig:
+    def get(self, name):
+        return os.environ.get(name) or None
+
+
+class FileConfig:
+    # JSON (.json) or TOML (anything else); read once, on first lookup.
+    def __init__(self, path):
+        self.path = path
+        self._values = None
+
+    def _load(self) -> dict:
+        if self._values is None:
+            try:
+                with open(self.path, "rb") as fh:
+                    raw = fh.read()
+            except OSError:
+                self._values = {}
+                return self._values
+            if self.path.endswith(".json"):
+                self._values = json.loads(raw)
+            else:
+                import tomllib
+                self._values = tomllib.loads(raw.decode("utf-8"))
+        return self._values
+
+    def get(self, name):
+        return self._load().get(name)
+
+
+class SecretsConfig:
+    def get(self, name):
+        try:
+            import streamlit as st
+            return st.secrets.get(name)
+        except Exception:
+            return None     # no streamlit, or no secrets file
+
+
+def default_providers() -> list:
+    providers = [EnvConfig()]
+    explicit  = os.environ.get("EXTRACT_CONFIG")
+    if explicit:
+        providers.append(FileConfig(explicit))
+    else:
+        providers.extend(FileConfig(path) for path in DEFAULT_FILES if os.path.isfile(path))
+    providers.append(SecretsConfig())
+    return providers
+
+
+_lock      = threading.Lock()
+_providers = None
+_values    = {}
+
+
+def use(*providers):
+    # Replaces the provider chain; no arguments restores the default one.
+    global _providers
+    with _lock:
+        _providers = list(providers) or None
+        _values.clear()
+
+
+def get(setting: str, default=None):
+    global _providers
+    with _lock:
+        if setting in _values:
+            return _values[setting]
+        if _providers is None:
+            _providers = default_providers()
+        value = None
+        for provider in _providers:
+            for name in KEYS.get(setting, (setting,)):
+                value = provider.get(name)
+                if value:
+                    break
+            if value:
+                break
+        if not value:
+            return default      # not cached: the setting may still be provided later
+        _values[setting] = value
+        return value
+
+
+def get_list(setting: str, default=None) -> list:
+    # Lists may be given as a list (TOML/JSON) or a comma-separated string.
+    value = get(setting)
+    if not value:
+        return list(default or [])
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return list(value)
@@ -0,0 +1,319 @@
+# fake_gemini.py — Local stand-in for google.genai.Client
+# ─────────────────────────────────────────────────────────────────────────────
+# Implements the parts of the SDK the backend uses — files.upload/delete,
+# models.generate_content_stream, caches.create/delete and their client.aio
+# counterparts — entirely in memory, so the extraction pipeline can be
+# exercised without network access or quota:
+#
+#   import app_v2, fake_gemini
+#   fake = fake_gemini.FakeClient()
+#   app_v2.get_client = lambda: fake
+#   app_v2.get_async_client = lambda: fake     # for the async path
+#   app_v2.CONTEXT_CACHE = True
+#   app_v2.extract_fields_ai(open("rate_card.pdf", "rb"), use_cache=False)
+#   fake.requests[-1]["cached_content"]      # → "cachedContents/1"
+#
+# Recorded responses, latency, truncation and errors are configurable, so the
+# same fake drives the offline benchmarks in bench_v2.py:
+#
+#   fake = FakeClient(response=load_recordings("recordings/"), first_chunk_latency=0.8,
+#                     latency=0.02, truncate_rate=0.05, errors={"429": 0.02, "503": 0.02, "timeout": 0.01})
+#
+# Recordings come from the real API via record(get_client(), "recordings/").
+
+import os
+import copy
+import json
+import time
+import random
+import asyncio
+import threading
+
+
+def _default_response() -> str:
+    from app_v2 import SERVICE_TEMPLATE
+
+    service = copy.deepcopy(SERVICE_TEMPLATE)
+    service.update({"service_name": "VIP Arrival", "airport": "LHR", "travel_type": "arrival"})
+    service["pricing"]["1_pax"]["adults"] = 475
+    return json.dumps([service], indent=2)
+
+
+def load_recordings(path) -> list:
+    # Response texts from a directory of .json/.txt files (sorted by name) or
+    # a .jsonl file of {"text": ...} lines, as written by record().
+    if os.path.isdir(path):
+        texts = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".json", ".txt")):
+                with open(os.path.join(path, name), "r", encoding="utf-8") as fh:
+                    texts.append(fh.read())
+        return texts
+    with open(path, "r", encoding="utf-8") as fh:
+        return [json.loads(line)["text"] for line in fh if line.strip()]
+
+
+class _Obj:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+# Messages close to what the SDK raises, so app_v2 classifies them the same way.
+_ERRORS = {
+    "429": "429 RESOURCE_EXHAUSTED. {'error': {'code': 429, 'message': 'Resource has been exhausted (e.g. check quota).'}}",
+    "503": "503 UNAVAILABLE. {'error': {'code': 503, 'message': 'The model is overloaded. Please try again later.'}}",
+    "500": "500 INTERNAL. {'error': {'code': 500, 'message': 'An internal error has occurred.'}}",
+}
+
+
+class FakeClient:
+    def __init__(self, response=None, chunk_size: int = 64, latency: float = 0.0,
+                 first_chunk_latency: float = 0.0, truncate_rate: float = 0.0, truncate_at: float = 0.6,
+                 errors=None, hang_seconds: float = 300.0, seed=None):
+        # response: a JSON string, a list of them (served in turn), or a
+        # callable(model, request) -> str
+        self.response   = response if response is not None else _default_response()
+        self.chunk_size = chunk_size
+        self.latency    = latency              # seconds slept before each chunk
+        self.first_chunk_latency = first_chunk_latency
+
+        # Fault injection. errors maps "429" / "503" / "500" / "timeout" to a
+        # per-request probability; a timeout hangs before the first chunk
+        # until the request's HTTP timeout (or hang_seconds) and then fails.
+        # A truncated response stops cleanly after truncate_at of its text, as
+        # when the model hits its output limit.
+        self.errors        = dict(errors or {})
+        self.hang_seconds  = hang_seconds
+        self.truncate_rate = truncate_rate
+        self.truncate_at   = truncate_at
+        self._rng          = random.Random(seed)
+
+        self.requests = []               # one dict per generate call
+        self.uploads  = {}               # name -> bytes
+        self.cached   = {}               # name -> {"model", "system_instruction", "expires_at"}
+        self._lock    = threading.Lock()
+        self._counter = 0
+        self._served  = 0
+
+        self.files  = _Files(self)
+        self.models = _Models(self)
+        self.caches = _Caches(self)
+        self.aio    = _Obj(files=_AsyncFiles(self), models=_AsyncModels(self), caches=_AsyncCaches(self))
+
+    def _next_id(self) -> int:
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def _response_text(self, model, request) -> str:
+        if callable(self.response):
+            return self.response(model, request)
+        if isinstance(self.response, (list, tuple)):
+            with self._lock:
+                self._served += 1
+                return self.response[(self._served - 1) % len(self.response)]
+        return self.response
+
+    def _draw_fault(self, request, config):
+        # Decides this request's fate up front: (error message or None,
+        # seconds to hang first, fraction of the text to send).
+        with self._lock:
+            draws = [(kind, self._rng.random()) for kind in self.errors]
+            cut   = self._rng.random() < self.truncate_rate
+        for kind, draw in draws:
+            if draw < self.errors[kind]:
+                request["fault"] = kind
+                if kind == "timeout":
+                    http = getattr(config, "http_options", None)
+                    limit = getattr(http, "timeout", None)
+                    hang = min(self.hang_seconds, limit / 1000) if limit else self.hang_seconds
+                    return "TIMEOUT: The read operation timed out", hang, 1.0
+                return _ERRORS[kind], 0.0, 1.0
+        if cut:
+            request["fault"] = "truncated"
+            return None, 0.0, self.truncate_at
+        return None, 0.0, 1.0
+
+    def _record_request(self, model, contents, config) -> dict:
+        parts = [p for c in contents for p in (getattr(c, "parts", None) or [])]
+        request = {
+            "model": model,
+            "cached_content": getattr(config, "cached_content", None),
+            "parts": len(parts),
+            "has_prompt": any(getattr(p, "text", None) for p in parts),
+            "at": time.time(),
+        }
+        with self._lock:
+            self.requests.append(request)
+        return request
+
+    def _check_cached_content(self, name):
+        if name is None:
+            return
+        entry = self.cached.get(name)
+        if entry is None or entry["expires_at"] <= time.time():
+            raise RuntimeError(f"404 NOT_FOUND. CachedContent not found (or expired): {name}")
+
+    def _chunks(self, text, keep: float = 1.0):
+        # The last chunk carries usage_metadata, as the real stream does; token
+        # counts are a rough 4 characters per token.
+        text   = text[:int(len(text) * keep)]
+        starts = range(0, len(text), self.chunk_size)
+        for i in starts:
+            usage = None
+            if i == starts[-1]:
+                output = max(1, len(text) // 4)
+                usage  = _Obj(prompt_token_count=1000, cached_content_token_count=0,
+                              candidates_token_count=output, thoughts_token_count=0,
+                              total_token_count=1000 + output)
+            yield _Obj(text=text[i:i + self.chunk_size], usage_metadata=usage)
+
+
+# ── SYNC API ──────────────────────────────────────────────────────────────────
+class _Files:
+    def __init__(self, fake):
+        self._fake = fake
+
+    def upload(self, file=None, config=None):
+        data = file.read() if hasattr(file, "read") else open(file, "rb").read()
+        n = self._fake._next_id()
+        name = f"files/fake-{n}"
+        self._fake.uploads[name] = data
+        return _Obj(name=name, uri=f"https://fake.local/{name}", size_bytes=len(data))
+
+    def delete(self, name=None):
+        self._fake.uploads.pop(name, None)
+
+
+class _Models:
+    def __init__(self, fake):
+        self._fake = fake
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        fake    = self._fake
+        request = fake._record_request(model, contents or [], config)
+        fake._check_cached_content(request["cached_content"])
+        error, hang, keep = fake._draw_fault(request, config)
+        if hang:
+            time.sleep(hang)
+        if error:
+            raise RuntimeError(error)
+        if fake.first_chunk_latency:
+            time.sleep(fake.first_chunk_latency)
+        for chunk in fake._chunks(fake._response_text(model, request), keep):
+            if fake.latency:
+                time.sleep(fake.latency)
+            yield chunk
+
+
+class _Caches:
+    def __init__(self, fake):
+        self._fake = fake
+
+    def create(self, model=None, config=None):
+        ttl = str(getattr(config, "ttl", None) or "3600s")
+        n = self._fake._next_id()
+        name = f"cachedContents/{n}"
+        self._fake.cached[name] = {
+            "model": model,
+            "system_instruction": getattr(config, "system_instruction", None),
+            "expires_at": time.time() + float(ttl.rstrip("s")),
+        }
+        return _Obj(name=name, model=model)
+
+    def delete(self, name=None):
+        self._fake.cached.pop(name, None)
+
+    def expire_all(self):
+        # Simulates server-side expiry of every cached content entry.
+        for entry in self._fake.cached.values():
+            entry["expires_at"] = 0
+
+
+# ── ASYNC API ─────────────────────────────────────────────────────────────────
+class _AsyncFiles:
+    def __init__(self, fake):
+        self._sync = _Files(fake)
+
+    async def upload(self, file=None, config=None):
+        return self._sync.upload(file=file, config=config)
+
+    async def delete(self, name=None):
+        self._sync.delete(name=name)
+
+
+class _AsyncModels:
+    def __init__(self, fake):
+        self._fake = fake
+
+    async def generate_content_stream(self, model=None, contents=None, config=None):
+        fake    = self._fake
+        request = fake._record_request(model, contents or [], config)
+        fake._check_cached_content(request["cached_content"])
+        error, hang, keep = fake._draw_fault(request, config)
+        if hang:
+            await asyncio.sleep(hang)
+        if error:
+            raise RuntimeError(error)
+        text    = fake._response_text(model, request)
+
+        async def _stream():
+            if fake.first_chunk_latency:
+                await asyncio.sleep(fake.first_chunk_latency)
+            for chunk in fake._chunks(text, keep):
+                if fake.latency:
+                    await asyncio.sleep(fake.latency)
+                yield chunk
+
+        return _stream()
+
+
+class _AsyncCaches:
+    def __init__(self, fake):
+        self._sync = _Caches(fake)
+
+    async def create(self, model=None, config=None):
+        return self._sync.create(model=model, config=config)
+
+    async def delete(self, name=None):
+        self._sync.delete(name=name)
+
+
+# ── RECORDING ─────────────────────────────────────────────────────────────────
+class _RecordingModels:
+    def __init__(self, models, directory):
+        self._models    = models
+        self._directory = directory
+        self._lock      = threading.Lock()
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        chunks = []
+        for chunk in self._models.generate_content_stream(model=model, contents=contents, config=config):
+            if chunk.text:
+                chunks.append(chunk.text)
+            yield chunk
+        with self._lock:
+            n = len(os.listdir(self._directory))
+            path = os.path.join(self._directory, f"{n:05d}_{model.rsplit('/', 1)[-1]}.json")
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write("".join(chunks))
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+
+class _RecordingClient:
+    def __init__(self, client, directory):
+        self._client = client
+        self.models  = _RecordingModels(client.models, directory)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def record(client, directory):
+    # Wraps a real client so every completed (sync) generate call saves its
+    # response text into `directory`, ready for load_recordings():
+    #   app_v2.get_client = lambda c=fake_gemini.record(app_v2.get_client(), "recordings"): c
+    os.makedirs(directory, exist_ok=True)
+    return _RecordingClient(client, directory)
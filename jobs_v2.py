@@ -0,0 +1,418 @@
+# jobs_v2.py — Durable extraction job queue (SQLite) with background workers
+# ─────────────────────────────────────────────────────────────────────────────
+# Uploaded PDFs are stored content-addressed on disk and queued as jobs in a
+# local SQLite database; worker processes claim jobs, run extract_fields_ai and
+# write the results back. The Streamlit app only enqueues and polls, so a
+# browser refresh or server restart loses nothing and model calls never block
+# the script thread.
+#
+# Usage:
+#   python jobs_v2.py worker --processes 2 --threads 4     # run workers
+#   python jobs_v2.py status <batch id>
+#   python jobs_v2.py worker --metrics-port 9108          # + /metrics per process
+#
+# Job lifecycle: queued → running → done | failed. A running job holds a lease
+# that its worker keeps extending; if the worker dies the lease runs out and
+# the job is claimed again, unless that was its last attempt. Failed attempts
+# are retried with backoff up to max_attempts.
+
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import argparse
+import threading
+import multiprocessing
+
+import metrics_v2 as metrics
+
+JOBS_DIR = os.environ.get(
+    "EXTRACT_JOBS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".extract_jobs")
+)
+JOBS_DB  = os.path.join(JOBS_DIR, "jobs.sqlite3")
+BLOB_DIR = os.path.join(JOBS_DIR, "pdfs")
+
+JOB_MAX_ATTEMPTS      = 3
+JOB_LEASE_SECONDS     = 120    # extended by heartbeats while the job runs
+JOB_RETRY_BACKOFF     = 15     # seconds × attempt number before a retry
+JOB_POLL_SECONDS      = 1.0
+PARTIAL_WRITE_SECONDS = 0.5    # how often streamed services are saved
+BLOB_GRACE_SECONDS    = 3600   # purge keeps unqueued PDFs this long (staged in the UI)
+SPOOL_BLOCK_BYTES     = 1024 * 1024
+
+# Worker processes the Streamlit app starts for itself; set to 0 when workers
+# run separately (python jobs_v2.py worker).
+WORKER_PROCESSES = int(os.environ.get("EXTRACT_JOB_WORKERS", 2))
+WORKER_THREADS   = 4           # concurrent jobs per worker process
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id      TEXT    NOT NULL,
+    filename      TEXT    NOT NULL,
+    sha256        TEXT    NOT NULL,
+    state         TEXT    NOT NULL DEFAULT 'queued'
+                  CHECK (state IN ('queued', 'running', 'done', 'failed')),
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    max_attempts  INTEGER NOT NULL DEFAULT 3,
+    available_at  REAL    NOT NULL,
+    lease_until   REAL,
+    worker        TEXT,
+    partial       TEXT,
+    result        TEXT,
+    error         TEXT,
+    created_at    REAL    NOT NULL,
+    updated_at    REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, available_at, id);
+CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id, id);
+"""
+
+_local = threading.local()
+
+
+# ── STORAGE ───────────────────────────────────────────────────────────────────
+def _db() -> sqlite3.Connection:
+    # One connection per thread (and per process — a forked child must not
+    # reuse its parent's).
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+def _blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}.pdf")
+
+
+def store_pdf(pdf_file):
+    # Spools a file-like to the blob store block by block, hashing as it goes,
+    # so a large upload is never held twice. Returns (sha256, size in bytes).
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    tmp    = os.path.join(BLOB_DIR, f"spool.{os.getpid()}.{threading.get_ident()}.tmp")
+    digest = hashlib.sha256()
+    size   = 0
+    with open(tmp, "wb") as fh:
+        for block in iter(lambda: pdf_file.read(SPOOL_BLOCK_BYTES), b""):
+            digest.update(block)
+            fh.write(block)
+            size += len(block)
+
+    sha256 = digest.hexdigest()
+    path   = _blob_path(sha256)
+    if os.path.exists(path):
+        os.remove(tmp)
+        os.utime(path)          # restart purge's grace period
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    return sha256, size
+
+
+# ── QUEUE API ─────────────────────────────────────────────────────────────────
+def new_batch_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def enqueue(pdf_bytes: bytes, filename: str, batch_id: str, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+    sha256, _size = store_pdf(io.BytesIO(pdf_bytes))
+    return enqueue_stored(sha256, filename, batch_id, max_attempts)
+
+
+def enqueue_stored(sha256: str, filename: str, batch_id: str, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+    # Queues a PDF already in the blob store (see store_pdf).
+    now = time.time()
+    cur = _db().execute(
+        "INSERT INTO jobs (batch_id, filename, sha256, max_attempts, available_at, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (batch_id, filename, sha256, max_attempts, now, now, now)
+    )
+    print(f"📥 [Jobs] Queued {filename} as job {cur.lastrowid} (batch {batch_id}).")
+    return cur.lastrowid
+
+
+def claim(worker: str, lease_seconds: float = JOB_LEASE_SECONDS):
+    # Takes the oldest runnable job: queued and due, or running with an
+    # expired lease (its worker died). A job whose worker died on its last
+    # allowed attempt — a PDF that crashes or OOM-kills the worker — is
+    # failed as worker_lost instead of being run again. Returns the row or
+    # None.
+    conn = _db()
+    now  = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        while True:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (state = 'queued' AND available_at <= ?) "
+                "OR (state = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None or row["state"] == "queued" or row["attempts"] < row["max_attempts"]:
+                break
+            error = {"error": "worker_lost",
+                     "detail": f"Worker {row['worker']} stopped during attempt {row['attempts']}/{row['max_attempts']}."}
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', lease_until = NULL, error = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(error), now, row["id"])
+            )
+            metrics.inc("jobs_total", outcome="worker_lost")
+            print(f"💀 [Jobs] Job {row['id']} ({row['filename']}) lost its worker on the last attempt — failed.")
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, "
+            "lease_until = ?, updated_at = ? WHERE id = ?",
+            (worker, now + lease_seconds, now, row["id"])
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return dict(row, attempts=row["attempts"] + 1, state="running", worker=worker)
+
+
+def heartbeat(job_id: int, worker: str, partial=None, lease_seconds: float = JOB_LEASE_SECONDS) -> bool:
+    # Extends the lease (and saves streamed services). False means the job
+    # was taken over by another worker and this one should stop writing.
+    now = time.time()
+    if partial is None:
+        cur = _db().execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (now + lease_seconds, now, job_id, worker)
+        )
+    else:
+        cur = _db().execute(
+            "UPDATE jobs SET lease_until = ?, partial = ?, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (now + lease_seconds, json.dumps(partial), now, job_id, worker)
+        )
+    return cur.rowcount == 1
+
+
+def _retryable(result) -> bool:
+    if result.get("error") != "model_call_failed":
+        return True
+    from app_v2 import _is_retryable
+    return _is_retryable(str(result.get("detail", "")))
+
+
+def complete(job: dict, worker: str, result) -> str:
+    # Records the outcome; failed attempts go back to the queue while
+    # attempts remain. An error carrying partial services still counts as a
+    # failed attempt; the last one keeps them in the error for the UI.
+    # Returns the job's new state, or None if the job is no longer held by
+    # this worker.
+    now = time.time()
+    if isinstance(result, dict) and result.get("error"):
+        if job["attempts"] < job["max_attempts"] and _retryable(result):
+            state, available_at = "queued", now + JOB_RETRY_BACKOFF * job["attempts"]
+        else:
+            state, available_at = "failed", now
+        cur = _db().execute(
+            "UPDATE jobs SET state = ?, available_at = ?, lease_until = NULL, error = ?, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (state, available_at, json.dumps(result), now, job["id"], worker)
+        )
+    else:
+        state = "done"
+        cur = _db().execute(
+            "UPDATE jobs SET state = 'done', lease_until = NULL, result = ?, error = NULL, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (json.dumps(result), now, job["id"], worker)
+        )
+    return state if cur.rowcount == 1 else None
+
+
+def batch_status(batch_id: str) -> list:
+    rows = _db().execute(
+        "SELECT id, filename, sha256, state, attempts, max_attempts, partial, result, error, updated_at "
+        "FROM jobs WHERE batch_id = ? ORDER BY id",
+        (batch_id,)
+    ).fetchall()
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        for col in ("partial", "result", "error"):
+            job[col] = json.loads(job[col]) if job[col] else None
+        jobs.append(job)
+    return jobs
+
+
+def queue_stats() -> dict:
+    rows = _db().execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+    return {"queued": 0, "running": 0, "done": 0, "failed": 0, **{r["state"]: r["n"] for r in rows}}
+
+
+def purge(max_age_seconds: float = 7 * 24 * 3600) -> int:
+    # Drops finished jobs older than max_age_seconds and PDFs no job uses.
+    conn = _db()
+    cur  = conn.execute(
+        "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+        (time.time() - max_age_seconds,)
+    )
+    live   = {r["sha256"] for r in conn.execute("SELECT DISTINCT sha256 FROM jobs")}
+    cutoff = time.time() - BLOB_GRACE_SECONDS
+    for root, _dirs, files in os.walk(BLOB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith((".pdf", ".tmp")) and name[:-4] not in live:
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+    return cur.rowcount
+
+
+# ── WORKERS ───────────────────────────────────────────────────────────────────
+def _run_job(job: dict, worker: str):
+    import app_v2
+
+    pdf_file = app_v2.PdfBuffer.open(_blob_path(job["sha256"]), name=job["filename"])
+
+    # Stream services into the job row as they arrive (the longest attempt
+    # wins, as in the UI) and keep the lease alive during long model calls.
+    lock, by_model, state = threading.Lock(), {}, {"written": 0.0, "alive": True}
+    stop = threading.Event()
+
+    def _on_service(model, service):
+        with lock:
+            by_model.setdefault(model, []).append(service)
+            if time.monotonic() - state["written"] < PARTIAL_WRITE_SECONDS:
+                return
+            state["written"] = time.monotonic()
+            best = list(max(by_model.values(), key=len))
+        state["alive"] = heartbeat(job["id"], worker, partial=best)
+
+    def _keep_alive():
+        while not stop.wait(JOB_LEASE_SECONDS / 3):
+            state["alive"] = heartbeat(job["id"], worker)
+
+    beat = threading.Thread(target=_keep_alive, daemon=True)
+    beat.start()
+    try:
+        result = app_v2.extract_fields_ai(pdf_file, on_service=_on_service)
+    except Exception as e:
+        result = {"error": "exception", "detail": f"{type(e).__name__}: {e}"}
+    finally:
+        stop.set()
+        beat.join()
+
+    outcome = complete(job, worker, result) if state["alive"] else None
+    metrics.inc("jobs_total", outcome=outcome or "lease_lost")
+    if outcome is None:
+        print(f"⚠️  [Jobs] Lost the lease on job {job['id']} — discarding this attempt.")
+        return
+    print(f"🏷️  [Jobs] Job {job['id']} ({job['filename']}) → {outcome} "
+          f"(attempt {job['attempts']}/{job['max_attempts']}).")
+
+
+def work(threads: int = WORKER_THREADS, stop_event=None, metrics_port=None):
+    # Runs `threads` claim loops in this process until stop_event is set.
+    import app_v2
+
+    stop_event = stop_event or threading.Event()
+    base = f"{socket.gethostname()}:{os.getpid()}"
+    # All worker processes draw from one rate-limit budget, kept in the jobs
+    # database unless EXTRACT_RATE_LIMIT_DB points elsewhere.
+    if not app_v2.RATE_LIMIT_DB:
+        app_v2.share_rate_limits(JOBS_DB)
+    if metrics_port:
+        metrics.register_collector("jobs", queue_stats)
+        metrics.serve(metrics_port)
+
+    def _loop(n):
+        worker = f"{base}:{n}"
+        while not stop_event.is_set():
+            try:
+                job = claim(worker)
+            except sqlite3.OperationalError as e:
+                print(f"⚠️  [Jobs] Claim failed ({e}) — retrying.")
+                job = None
+            if job is None:
+                stop_event.wait(JOB_POLL_SECONDS)
+                continue
+            _run_job(job, worker)
+
+    loops = [threading.Thread(target=_loop, args=(n,), name=f"jobs-{n}", daemon=True) for n in range(threads)]
+    for t in loops:
+        t.start()
+    print(f"👷 [Jobs] Worker {base} running {threads} thread(s) on {JOBS_DB}")
+    for t in loops:
+        t.join()
+
+
+_workers_lock = threading.Lock()
+_workers      = []
+
+
+def ensure_workers(processes: int = WORKER_PROCESSES, threads: int = WORKER_THREADS):
+    # Starts background worker processes once per server process; safe to
+    # call on every Streamlit rerun. Spawned rather than forked so they don't
+    # inherit the server's threads.
+    with _workers_lock:
+        _workers[:] = [p for p in _workers if p.is_alive()]
+        ctx = multiprocessing.get_context("spawn")
+        while len(_workers) < processes:
+            proc = ctx.Process(target=work, args=(threads,), name="extract-worker", daemon=True)
+            proc.start()
+            _workers.append(proc)
+
+
+# ── CLI ───────────────────────────────────────────────────────────────────────
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF Extractor job queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_worker = sub.add_parser("worker", help="process queued jobs until interrupted")
+    p_worker.add_argument("--processes", type=int, default=WORKER_PROCESSES)
+    p_worker.add_argument("--threads", type=int, default=WORKER_THREADS)
+    p_worker.add_argument("--metrics-port", type=int, default=None,
+                          help="serve /metrics from each process, on consecutive ports from this one")
+
+    p_status = sub.add_parser("status", help="show queue totals, or one batch")
+    p_status.add_argument("batch_id", nargs="?")
+
+    p_purge = sub.add_parser("purge", help="delete finished jobs and unused PDFs")
+    p_purge.add_argument("--days", type=float, default=7)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        port = args.metrics_port
+        if args.processes <= 1:
+            work(args.threads, metrics_port=port)
+        else:
+            ctx   = multiprocessing.get_context("spawn")
+            procs = [ctx.Process(target=work, args=(args.threads, None, port + i if port else None))
+                     for i in range(args.processes)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+    elif args.command == "status":
+        if args.batch_id:
+            for job in batch_status(args.batch_id):
+                print(f"{job['id']:>6}  {job['state']:<8} {job['attempts']}/{job['max_attempts']}  {job['filename']}")
+        else:
+            print(json.dumps(queue_stats(), indent=2))
+    elif args.command == "purge":
+        print(f"🧹 [Jobs] Purged {purge(args.days * 24 * 3600)} job(s).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
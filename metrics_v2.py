@@ -0,0 +1,279 @@
+# metrics_v2.py — Stage timings and counters for the PDF Extractor
+# ─────────────────────────────────────────────────────────────────────────────
+# In-process instrumentation for app_v2: stage timers (read, upload, first
+# chunk, stream, parse, repair, delete…), counters (model attempts, fallbacks,
+# token usage) and the existing get_*_stats() snapshots, exported as
+# Prometheus text or JSON lines. Recording is a dict update under one lock, so
+# it is cheap enough for the hot path.
+#
+#   with metrics.stage("upload"):
+#       ...
+#   metrics.inc("model_attempts_total", model=model, outcome="ok")
+#
+#   metrics.serve(9108)                     # GET /metrics (Prometheus), /metrics.json
+#   metrics.write_jsonl("metrics.jsonl")    # append one snapshot line
+
+import json
+import time
+import bisect
+import inspect
+import functools
+import threading
+
+NAMESPACE     = "pdf_extractor"
+STAGE_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock       = threading.Lock()
+_counters   = {}    # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [per-bucket counts…, +Inf count, sum]
+_collectors = {}    # prefix -> (callable returning a stats dict, label name or None)
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, v) for k, v in labels.items() if v is not None)) if labels else ()
+
+
+# ── RECORDING ─────────────────────────────────────────────────────────────────
+def inc(name: str, value: float = 1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    key = (name, _labels(labels))
+    i = bisect.bisect_left(STAGE_BUCKETS, seconds)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(STAGE_BUCKETS) + 2)
+        hist[i]  += 1
+        hist[-1] += seconds
+
+
+class stage:
+    # Context manager timing one pipeline stage into stage_seconds{stage=…}.
+    __slots__ = ("labels", "started")
+
+    def __init__(self, name: str, **labels):
+        self.labels = dict(labels, stage=name)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe("stage_seconds", time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def timed(name: str, status=None):
+    # Decorator for a whole operation: records stage_seconds{stage=name} and
+    # <name>_total{status=status(result)}; exceptions count as "exception".
+    def _status(result):
+        return status(result) if status is not None else "ok"
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started, outcome = time.perf_counter(), "exception"
+                try:
+                    result = await fn(*args, **kwargs)
+                    outcome = _status(result)
+                    return result
+                finally:
+                    observe("stage_seconds", time.perf_counter() - started, stage=name)
+                    inc(f"{name}_total", status=outcome)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started, outcome = time.perf_counter(), "exception"
+                try:
+                    result = fn(*args, **kwargs)
+                    outcome = _status(result)
+                    return result
+                finally:
+                    observe("stage_seconds", time.perf_counter() - started, stage=name)
+                    inc(f"{name}_total", status=outcome)
+        return wrapper
+    return decorate
+
+
+def register_collector(prefix: str, fn, label=None):
+    # fn() returns a stats dict exported as gauges <prefix>_<key>. With label
+    # set, the dict is keyed by that label's values ({model: {key: value}}).
+    # Non-numeric values are skipped.
+    with _lock:
+        _collectors[prefix] = (fn, label)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# ── SNAPSHOTS ─────────────────────────────────────────────────────────────────
+def _percentile(hist, q):
+    # Upper bound of the bucket holding the q-th observation.
+    total = sum(hist[:-1])
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(STAGE_BUCKETS + (float("inf"),), hist[:-1]):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return float("inf")
+
+
+def _collect():
+    with _lock:
+        collectors = dict(_collectors)
+    stats = {}
+    for prefix, (fn, label) in collectors.items():
+        try:
+            stats[prefix] = (fn(), label)
+        except Exception as e:
+            print(f"⚠️  [Metrics] Collector {prefix} failed: {e}")
+    return stats
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters   = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    return {
+        "at": time.time(),
+        "counters": [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(counters.items())
+        ],
+        "timers": [
+            {"name": name, "labels": dict(labels), "count": sum(hist[:-1]),
+             "sum": round(hist[-1], 6), "p50_le": _percentile(hist, 0.5), "p95_le": _percentile(hist, 0.95)}
+            for (name, labels), hist in sorted(histograms.items())
+        ],
+        "stats": {prefix: stats for prefix, (stats, _label) in _collect().items()},
+    }
+
+
+def write_jsonl(path: str) -> dict:
+    snap = snapshot()
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(json.dumps(snap, default=str) + "\n")
+    return snap
+
+
+# ── PROMETHEUS ────────────────────────────────────────────────────────────────
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _fmt_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    return None
+
+
+def render_prometheus() -> str:
+    with _lock:
+        counters   = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    lines, typed = [], set()
+
+    def _type(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        metric = f"{NAMESPACE}_{name}"
+        _type(metric, "counter")
+        lines.append(f"{metric}{_fmt_labels(labels)} {value}")
+
+    for (name, labels), hist in sorted(histograms.items()):
+        metric = f"{NAMESPACE}_{name}"
+        _type(metric, "histogram")
+        cumulative = 0
+        for bound, count in zip(STAGE_BUCKETS + ("+Inf",), hist[:-1]):
+            cumulative += count
+            lines.append(f"{metric}_bucket{_fmt_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{metric}_sum{_fmt_labels(labels)} {hist[-1]}")
+        lines.append(f"{metric}_count{_fmt_labels(labels)} {cumulative}")
+
+    # Samples of one metric must be contiguous, so labelled rows are grouped
+    # by key first.
+    gauges = {}
+    for prefix, (stats, label) in sorted(_collect().items()):
+        rows = stats.items() if label else [(None, stats)]
+        for label_value, values in rows:
+            if not isinstance(values, dict):
+                continue
+            labels = ((label, label_value),) if label else ()
+            for key, value in values.items():
+                value = _number(value)
+                if value is not None:
+                    gauges.setdefault(f"{NAMESPACE}_{prefix}_{key}", []).append((labels, value))
+
+    for metric, samples in gauges.items():
+        _type(metric, "gauge")
+        lines.extend(f"{metric}{_fmt_labels(labels)} {value}" for labels, value in samples)
+
+    return "\n".join(lines) + "\n"
+
+
+# ── HTTP ENDPOINT ─────────────────────────────────────────────────────────────
+# http.server is imported only when an endpoint is started; it would otherwise
+# be most of this module's import time.
+def _handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, ctype = render_prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body, ctype = json.dumps(snapshot(), default=str).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Handler
+
+
+_server_lock = threading.Lock()
+_server      = None
+
+
+def serve(port: int, host: str = "127.0.0.1"):
+    # Starts the endpoint on a daemon thread; later calls return the running
+    # server.
+    global _server
+    with _server_lock:
+        if _server is None:
+            from http.server import ThreadingHTTPServer
+
+            _server = ThreadingHTTPServer((host, port), _handler())
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"📊 [Metrics] Serving http://{host}:{_server.server_address[1]}/metrics")
+        return _server
@@ -0,0 +1,108 @@
+# review_v2.py — Review state for the verification UI
+# ─────────────────────────────────────────────────────────────────────────────
+# Widget keys, per-file verification counts and field edits, kept free of
+# Streamlit so they can be used (and checked) without a running app.
+#
+# Widget keys follow the scheme render_field in app_streamlit_v2.py uses:
+#   value_<keyified path> / verify_<keyified path>     for flat fields
+#   value_<path>_<pax>_adults|children / verify_<path>_<pax>   for pricing rows
+# where path starts with "<file key>_service_<n>".
+
+
+def keyify(path):
+    return path.replace(".", "_").replace("[", "_").replace("]", "")
+
+
+def _widgets(path, value, loc):
+    # Yields (verify key, [(value key, location in the service)]) for every
+    # row render_field draws for this value.
+    if path.endswith("pricing") and isinstance(value, dict):
+        for pax in value:
+            yield f"verify_{path}_{pax}", [
+                (f"value_{path}_{pax}_{who}", loc + (pax, who)) for who in ("adults", "children")
+            ]
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            yield from _widgets(f"{path}.{k}", v, loc + (k,))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            yield from _widgets(f"{path}[{i}]", item, loc + (i,))
+    else:
+        yield f"verify_{keyify(path)}", [(f"value_{keyify(path)}", loc)]
+
+
+class VerificationIndex:
+    # Per-file verified/total counters maintained from widget callbacks, so
+    # "is this file verified" and "X of Y verified" are O(1) lookups. Edits
+    # are kept per file and applied on rebuild; untouched fields cost nothing.
+    __slots__ = ("_file_of", "_total", "_done", "_ticked", "_locations", "_edits")
+
+    def __init__(self):
+        self._file_of   = {}    # verify key -> file key
+        self._total     = {}    # file key -> number of verify keys
+        self._done      = {}    # file key -> number ticked
+        self._ticked    = set()
+        self._locations = {}    # value key -> (file key, service index, path)
+        self._edits     = {}    # file key -> {value key: edited value}
+
+    def register(self, file_key, services):
+        if file_key in self._total:
+            return
+        total = 0
+        for i, svc in enumerate(services):
+            for verify_key, values in _widgets(f"{file_key}_service_{i + 1}", svc, ()):
+                self._file_of[verify_key] = file_key
+                for value_key, loc in values:
+                    self._locations[value_key] = (file_key, i, loc)
+                total += 1
+        self._total[file_key] = total
+        self._done[file_key]  = 0
+        self._edits[file_key] = {}
+
+    def is_registered(self, file_key) -> bool:
+        return file_key in self._total
+
+    # ── verification ─────────────────────────────────────────────────────────
+    def set_verified(self, verify_key, ticked: bool):
+        file_key = self._file_of.get(verify_key)
+        if file_key is None or ticked == (verify_key in self._ticked):
+            return
+        if ticked:
+            self._ticked.add(verify_key)
+            self._done[file_key] += 1
+        else:
+            self._ticked.discard(verify_key)
+            self._done[file_key] -= 1
+
+    def is_checked(self, verify_key) -> bool:
+        return verify_key in self._ticked
+
+    def progress(self, file_key):
+        return self._done.get(file_key, 0), self._total.get(file_key, 0)
+
+    def is_verified(self, file_key) -> bool:
+        done, total = self.progress(file_key)
+        return total > 0 and done == total
+
+    # ── edits ────────────────────────────────────────────────────────────────
+    def set_edit(self, value_key, value):
+        where = self._locations.get(value_key)
+        if where is not None:
+            self._edits[where[0]][value_key] = value
+
+    def edit_value(self, value_key, default):
+        where = self._locations.get(value_key)
+        if where is None:
+            return default
+        return self._edits[where[0]].get(value_key, default)
+
+    def rebuild(self, file_key, services):
+        # Writes this file's edits into `services` (fresh dicts the caller
+        # owns) and returns it.
+        for value_key, value in self._edits.get(file_key, {}).items():
+            _, i, loc = self._locations[value_key]
+            node = services[i]
+            for step in loc[:-1]:
+                node = node[step]
+            node[loc[-1]] = value
+        return services
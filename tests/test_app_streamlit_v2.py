@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+# The app starts job workers and opens the jobs DB at import; point it at a
+# throwaway queue with no workers before anything imports jobs_v2.
+os.environ["EXTRACT_JOBS_DIR"]    = tempfile.mkdtemp(prefix="extract_jobs_")
+os.environ["EXTRACT_JOB_WORKERS"] = "0"
+
+from streamlit.testing.v1 import AppTest
+
+import jobs_v2 as jobs
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app_streamlit_v2.py")
+
+SERVICE = {"service_name": "Airport transfer", "travel_type": "private"}
+
+
+def finished_batch(result):
+    # One job already extracted, as a worker would leave it.
+    batch_id = jobs.new_batch_id()
+    jobs.enqueue(b"%PDF-1.4 test", "tour.pdf", batch_id)
+    job = jobs.claim("test")
+    jobs.complete(job, "test", result)
+    return batch_id
+
+
+def test_ticking_the_last_field_verifies_the_file_without_looping():
+    batch_id = finished_batch([SERVICE])
+    at = AppTest.from_file(APP, default_timeout=10)
+    at.query_params["batch"] = batch_id
+    at.run()
+    assert not at.exception
+
+    at.toggle(key="open_tour_pdf_1").set_value(True).run()
+    boxes = [box for box in at.checkbox if box.key.startswith("verify_")]
+    assert boxes and not at.success
+
+    # The final tick flips the file to verified from inside the fragment;
+    # that must trigger one full rerun, not an endless chain of them.
+    for box in boxes:
+        at.checkbox(key=box.key).check().run()
+        assert not at.exception
+
+    assert [s.value for s in at.success] == ["tour.pdf verified!"]
+    assert at.session_state.file_verified["tour_pdf"] is True
+
+    # Untick one: back to unverified, again without looping.
+    at.checkbox(key=boxes[0].key).uncheck().run()
+    assert not at.exception
+    assert not at.success
+    assert at.session_state.file_verified["tour_pdf"] is False